@@ -1,7 +1,7 @@
+import bisect
 import logging
 import weakref
 import itertools
-import collections
 
 from lighthouse.util import *
 from lighthouse.palette import compute_color_on_gradiant
@@ -79,8 +79,30 @@ class DatabaseCoverage(object):
         # regard to what data sources we can consue (inst trace, coverage, etc)
         # and ways we can leverage said data (visualize coverage, heatmaps)
         #
+        # NOTE/PERF:
+        #
+        #   a dict based hitmap costs well over 100 bytes per executed
+        #   address. the CompactHitmap (see util/hitmap.py) stores the same
+        #   mapping as two sorted arrays, at ~16 bytes per executed address.
+        #
+        # NOTE/BLOCKS:
+        #
+        #   coverage can also be given as a BlockHitmap of (start, size, hits)
+        #   basic blocks. the blocks are then kept as the raw data, and the
+        #   hitmap is expanded from them against the installed metadata only
+        #   once it is needed (see _expand_blocks). it is expanded again if
+        #   the instructions of the metadata change under a full refresh.
+        #
 
-        self._hitmap = build_hitmap(data)
+        if isinstance(data, BlockHitmap):
+            self._blocks = data
+            self._hitmap = CompactHitmap()
+        else:
+            self._blocks = None
+            self._hitmap = CompactHitmap(data)
+
+        # the instruction array the blocks were last expanded against
+        self._expanded_instructions = None
 
         #
         # the coverage hash is a simple hash of the coverage bitmap/mask.
@@ -88,15 +110,26 @@ class DatabaseCoverage(object):
         # coverage, and predicting outputs of logical / arithmetic operations.
         #
         # the hash will need to be updated via _update_coverage_hash() anytime
-        # the hitmap is modified or changed internally. we cache a concrete
-        # result of the coverage hash because computing the hash on demand can
-        # be expensive in terms of time.
+        # addresses are added to, or removed from the hitmap. the hash is order
+        # independent, so it is updated with just the addresses that changed,
+        # rather than re-hashing the entire coverage mask.
         #
         # see the usage of 'coverage_hash' in director.py for more info
         #
 
         self.coverage_hash = 0
-        self._update_coverage_hash()
+        self._update_coverage_hash(self._hitmap.addresses)
+
+        #
+        # the instruction bitmap is a cached encoding of the coverage mask
+        # over the instruction ordinals of the database metadata. it is what
+        # makes the set algebra of coverage composition fast.
+        #
+        # the bitmap is built on demand (see the 'coverage' property), but
+        # compositions can be seeded with the bitmap that produced them
+        #
+
+        self._bitmap = data if isinstance(data, InstructionBitmap) else None
 
         #
         # Lighthouse will only compute coverage for code within defined
@@ -104,11 +137,11 @@ class DatabaseCoverage(object):
         # into its appropriate NodeCoverage object (eg, a basic block) or it
         # will be considered 'unmapped'
         #
-        # starting out, all coverage data is marked as unmapped
+        # starting out, all coverage data is marked as unmapped. the set of
+        # unmapped addresses shares its (sorted) array with the hitmap
         #
 
-        self._unmapped_data = set(self._hitmap.keys())
-        self._unmapped_data.add(idaapi.BADADDR)
+        self._unmapped_data = self._hitmap.viewkeys()
 
         #
         # self._map_coverage is responsible for mapping coverage data to the
@@ -125,6 +158,14 @@ class DatabaseCoverage(object):
         self.nodes     = {}
         self.functions = {}
 
+        #
+        # unmapping nodes (eg, when subtracting data) can leave functions
+        # with fewer nodes than they were last finalized with. such functions
+        # are tracked here, so that they are re-finalized on the next refresh
+        #
+
+        self._dirty_functions = {}
+
         #
         # we instantiate a single weakref of ourself (the DatbaseMapping
         # object) such that we can distribute it to the children we create
@@ -142,14 +183,39 @@ class DatabaseCoverage(object):
         """
         The data (a hitmap) used by this mapping.
         """
+        if self._expanded_instructions is None:
+            self._expand_blocks()
         return self._hitmap
 
+    @property
+    def blocks(self):
+        """
+        The block data (a BlockHitmap) used by this mapping, if any.
+        """
+        return self._blocks
+
     @property
     def coverage(self):
         """
         The instruction-level coverage bitmap/mask of this mapping.
         """
-        return self._hitmap.viewkeys()
+        if self._expanded_instructions is None:
+            self._expand_blocks()
+        instructions = self._metadata.instruction_addresses
+
+        #
+        # (re)build the instruction bitmap if the coverage data has changed,
+        # or if the metadata has assigned new instruction ordinals.
+        #
+        # a bitmap seeded by a composition is kept while this mapping only
+        # holds stub metadata, as it would have no ordinals to re-encode to
+        #
+
+        if self._bitmap is None or \
+            (instructions and self._bitmap.instructions is not instructions):
+            self._bitmap = InstructionBitmap(self._hitmap.addresses, instructions)
+
+        return self._bitmap
 
     @property
     def instruction_percent(self):
@@ -184,13 +250,48 @@ class DatabaseCoverage(object):
         if delta:
             self._unmap_delta(delta)
 
-    def refresh(self):
+    def refresh(self, delta=None):
         """
         Refresh the mapping of our coverage data to the database metadata.
+
+        If a metadata delta is given (as passed to update_metadata), only the
+        coverage that falls within the nodes it added or modified is mapped.
         """
 
+        #
+        # coverage held as blocks is expanded to instructions on its first
+        # refresh. a full refresh expands it again if the instructions have
+        # changed since, eg. to pick up functions that were still being
+        # collected when it was first expanded
+        #
+
+        if delta is None or self._expanded_instructions is None:
+            if self._expand_blocks():
+                delta = None
+
         # rebuild our coverage mapping
-        dirty_nodes, dirty_functions = self._map_coverage()
+        dirty_nodes, dirty_functions = self._map_coverage(delta)
+
+        # bake our coverage map
+        self._finalize(dirty_nodes, dirty_functions)
+
+    def refresh_data(self, data):
+        """
+        Refresh the mapping of just the given runtime data.
+
+        This is a fast refresh for data that was just added by add_data()
+        (eg, coverage appended to a live log). Only the given data is mapped,
+        rather than all of the data that remains unmapped.
+        """
+        assert self._blocks is None, "Block data must be expanded by a full refresh"
+
+        # map the given data to nodes, and the nodes to functions
+        dirty_nodes = self._map_nodes(data.addresses)
+        dirty_functions = self._map_functions(dirty_nodes)
+
+        # functions that lost nodes while unmapping must be re-finalized too
+        dirty_functions.update(self._dirty_functions)
+        self._dirty_functions = {}
 
         # bake our coverage map
         self._finalize(dirty_nodes, dirty_functions)
@@ -231,13 +332,14 @@ class DatabaseCoverage(object):
         """
         Add runtime data to this mapping.
         """
+        self._detach_blocks()
 
         # add the given runtime data to our data source
-        for address, hit_count in data.iteritems():
-            self._hitmap[address] += hit_count
+        added = self._hitmap.add(data)
 
-        # update the coverage hash incase the hitmap changed
-        self._update_coverage_hash()
+        # update the coverage hash with any addresses new to the hitmap
+        self._update_coverage_hash(added)
+        self._bitmap = None
 
         # mark these touched addresses as dirty
         self._unmapped_data |= data.viewkeys()
@@ -246,32 +348,29 @@ class DatabaseCoverage(object):
         """
         Subtract runtime data from this mapping.
         """
+        self._detach_blocks()
 
         # subtract the given runtime data from our data source
-        for address, hit_count in data.iteritems():
-            self._hitmap[address] -= hit_count
+        removed = self._hitmap.subtract(data)
 
-            #assert self._hitmap[address] >= 0
+        # update the coverage hash with any addresses dropped from the hitmap
+        self._update_coverage_hash(removed)
+        self._bitmap = None
 
-            #
-            # if there is no longer any hits for this address, delete its
-            # entry from the source_data dictonary. we don't want its entry to
-            # hang around because we use self._hitmap.viewkeys() as a
-            # coverage bitmap/mask
-            #
-
-            if not self._hitmap[address]:
-                del self._hitmap[address]
-
-        # update the coverage hash incase the hitmap changed
-        self._update_coverage_hash()
+        # addresses without any hits left are no longer coverage to be mapped
+        if removed:
+            self._unmapped_data -= AddressSet.from_sorted(removed)
 
         #
-        # unmap everything because a complete re-mapping is easier with the
-        # current implementation of things
+        # only the nodes containing subtracted data have changed. we unmap
+        # just those nodes, so that the next refresh re-maps whatever data
+        # they still hold, and drops those that no longer have any coverage.
+        #
+        # this keeps the cost of a subtraction in proportion to the data
+        # being subtracted, rather than the data that remains.
         #
 
-        self._unmap_all()
+        self._unmap_nodes(self._find_nodes(data.addresses))
 
     #--------------------------------------------------------------------------
     # Coverage Operations
@@ -283,83 +382,135 @@ class DatabaseCoverage(object):
 
         Returns a new DatabaseCoverage containing the masked hitmap.
         """
-        composite_data = collections.defaultdict(int)
 
         # preserve only hitmap data that matches the coverage mask
-        for address in coverage_mask:
-            composite_data[address] = self._hitmap[address]
+        composite_data = self.data.mask(coverage_mask)
 
         # done, return a new DatabaseCoverage masked with the given coverage
         return DatabaseCoverage(composite_data, self.palette)
 
-    def _update_coverage_hash(self):
+    def _expand_blocks(self):
         """
-        Update the hash of the coverage mask.
+        Expand the block data (if any) to instructions of the installed metadata.
+
+        Returns True if the data was (re)expanded, and must be mapped anew.
         """
-        if self._hitmap:
-            self.coverage_hash = hash(frozenset(self._hitmap.viewkeys()))
-        else:
-            self.coverage_hash = 0
+        if self._blocks is None:
+            return False
+
+        # the blocks are already expanded against these instructions
+        instructions = self._metadata.instruction_addresses
+        if self._expanded_instructions is instructions:
+            return False
+
+        self._hitmap = self._blocks.expand(self._metadata)
+        self._expanded_instructions = instructions
+
+        # the expanded data replaces whatever was mapped before it
+        self.coverage_hash = 0
+        self._update_coverage_hash(self._hitmap.addresses)
+        self._bitmap = None
+        self._unmap_all()
+        return True
+
+    def _detach_blocks(self):
+        """
+        Detach the block data, keeping its expansion as the raw data.
+
+        Once hits are added to (or subtracted from) the expanded hitmap, it
+        no longer matches the blocks it was expanded from.
+        """
+        if self._blocks is None:
+            return
+        if self._expanded_instructions is None:
+            self._expand_blocks()
+        self._blocks = None
+
+    def _update_coverage_hash(self, changed_addresses):
+        """
+        Update the hash of the coverage mask with added or removed addresses.
+        """
+        self.coverage_hash ^= address_hash(changed_addresses)
 
     #--------------------------------------------------------------------------
     # Coverage Mapping
     #--------------------------------------------------------------------------
 
-    def _map_coverage(self):
+    def _map_coverage(self, delta=None):
         """
         Map loaded coverage data to the given database metadata.
         """
 
         # re-map any unmapped coverage to nodes
-        dirty_nodes = self._map_nodes()
+        if delta is None:
+            dirty_nodes = self._map_nodes()
+
+        # or just the unmapped coverage that may fall within the delta nodes
+        else:
+            dirty_nodes = self._map_delta_nodes(delta)
 
         # re-map nodes to functions
         dirty_functions = self._map_functions(dirty_nodes)
 
+        # functions that lost nodes while unmapping must be re-finalized too
+        dirty_functions.update(self._dirty_functions)
+        self._dirty_functions = {}
+
         # return the modified objects
         return (dirty_nodes, dirty_functions)
 
-    def _map_nodes(self):
+    def _map_nodes(self, addresses=None):
         """
         Map loaded runtime data to database defined nodes (basic blocks).
+
+        If a sorted array of (unmapped) addresses is given, only those are
+        mapped. Otherwise, all of the unmapped data is mapped.
         """
         dirty_nodes = {}
-        addresses_to_map = collections.deque(sorted(self._unmapped_data))
+        still_unmapped = address_array()
+        mapped = address_array()
+
+        # the sorted addresses to map
+        if addresses is None:
+            addresses = self._unmapped_data.addresses
+            partial = False
+        else:
+            partial = True
+
+        # the node index to map them to
+        node_addresses = self._metadata.node_addresses
+        nodes = self._metadata.nodes
 
         #
-        # This while loop is the core of our coverage mapping process.
+        # This loop is the core of our coverage mapping process.
         #
-        # The '_unmapped_data' list is consumed by this loop, mapping
-        # any unmapped runtime data maintained by this DatabaseCoverage
-        # to the given database metadata.
+        # The sorted '_unmapped_data' addresses are walked against the node
+        # (basic block) interval index of the database metadata in a single
+        # merge pass. The metadata hands back runs of addresses that fall
+        # within the same node (or within no node at all), mapping any
+        # unmapped runtime data maintained by this DatabaseCoverage to the
+        # given database metadata.
         #
         # It should be noted that the rest of the database coverage
         # mapping (eg functions) gets built ontop of the mappings we build
         # for nodes here using the more or less raw/recycled runtime data.
         #
 
-        while addresses_to_map:
-
-            # get the next address to map
-            address = addresses_to_map.popleft()
-
-            # get the node (basic block) that contains this address
-            try:
-                node_metadata = self._metadata.get_node(address)
-
-            #
-            # failed to locate the node (basic block) for this address.
-            # this address must not fall inside of a defined function...
-            #
+        for node_index, start, end in self._metadata.iter_node_runs(addresses):
 
-            except ValueError:
+            # this run of addresses is not within a defined node, it remains unmapped
+            if node_index < 0:
+                if not partial:
+                    still_unmapped.extend(addresses[start:end])
                 continue
 
             #
-            # we found applicable node metadata for this address, now try
-            # to find the mapping object for this node address
+            # we found applicable node metadata for this run, now try to find
+            # the mapping object for this node address
             #
 
+            node_metadata = nodes[node_addresses[node_index]]
+
             if node_metadata.address in self.nodes:
                 node_coverage = self.nodes[node_metadata.address]
 
@@ -373,52 +524,82 @@ class DatabaseCoverage(object):
                 node_coverage = NodeCoverage(node_metadata.address, self._weak_self)
                 self.nodes[node_metadata.address] = node_coverage
 
-            # compute the basic block end now to reduce overhead in the loop below
-            node_end = node_metadata.address + node_metadata.size
-
             #
-            # the loop below can be thought of almost as an inlined fast-path
-            # where we expect the next several addresses to belong to the same
-            # node (basic block).
-            #
-            # with the assumption of linear program execution, we can reduce
-            # the heavier overhead of all the lookup code above by simply
-            # checking if the next address in the queue (addresses_to_map)
-            # falls into the same / current node (basic block).
-            #
-            # we can simply re-use the current node and its coverage object
-            # until the next address to be processed falls outside our scope
+            # as the hitmap is sorted, the executed instructions of this node
+            # are a contiguous run of hitmap entries. we map them to the node
+            # as a single slice, rather than one address at a time.
             #
 
-            while 1:
+            node_coverage.executed_instructions = self._hitmap.slice(
+                node_metadata.address,
+                node_metadata.address + node_metadata.size
+            )
+
+            # since we updated this node, ensure we're tracking it as dirty
+            dirty_nodes[node_metadata.address] = node_coverage
 
-                # map the hitmap data for the current address to this node mapping
-                node_coverage.executed_instructions[address] = self._hitmap[address]
-                self._unmapped_data.discard(address)
+            if partial:
+                mapped.extend(addresses[start:end])
 
-                # get the next address to attempt mapping on
-                address = addresses_to_map.popleft()
+        #
+        # when mapping just the given addresses, those that were mapped are
+        # carved out of the unmapped data (at a cost in proportion to them).
+        # otherwise, whatever could not be mapped to a node remains unmapped
+        #
 
-                #
-                # if the next address is not in this node, it's time break out
-                # of this loop and send it through the full node lookup path
-                #
+        if partial:
+            if mapped:
+                self._unmapped_data -= AddressSet.from_sorted(mapped)
+        else:
+            self._unmapped_data = AddressSet.from_sorted(still_unmapped)
 
-                if not (node_metadata.address <= address < node_end):
-                    addresses_to_map.appendleft(address)
-                    break
+        # done
+        return dirty_nodes
 
-                #
-                # the next address to be mapped DOES fall within our current
-                # node, loop back around in the fast-path and map it
-                #
+    def _map_delta_nodes(self, delta):
+        """
+        Map unmapped runtime data to the nodes added or modified by a delta.
+        """
+        dirty_nodes = {}
+        mapped = address_array()
 
-                # ...
+        addresses = self._unmapped_data.addresses
+        nodes = self._metadata.nodes
 
-            # since we updated this node, ensure we're tracking it as dirty
-            dirty_nodes[node_metadata.address] = node_coverage
+        #
+        # when metadata is streamed in small deltas (eg, while it is still
+        # being collected) sweeping all of the unmapped data for every delta
+        # would be wasteful. instead, we look up the run of unmapped data
+        # that falls within each of the delta's nodes directly
+        #
+
+        for node_address in sorted(delta.nodes_added | delta.nodes_modified):
+            node_metadata = nodes.get(node_address, None)
+            if not node_metadata:
+                continue
+
+            # find the run of unmapped addresses that fall within this node
+            node_end = node_address + node_metadata.size
+            start = bisect.bisect_left(addresses, node_address)
+            end = bisect.bisect_left(addresses, node_end, start)
+            if start == end:
+                continue
+
+            # get (or create) the coverage object for this node
+            node_coverage = self.nodes.get(node_address, None)
+            if not node_coverage:
+                node_coverage = NodeCoverage(node_address, self._weak_self)
+                self.nodes[node_address] = node_coverage
+
+            # map the executed instructions of this node as a single slice
+            node_coverage.executed_instructions = self._hitmap.slice(node_address, node_end)
+            dirty_nodes[node_address] = node_coverage
+            mapped.extend(addresses[start:end])
+
+        # the data that was mapped is no longer unmapped
+        if mapped:
+            self._unmapped_data -= AddressSet.from_sorted(mapped)
 
-        # done
         return dirty_nodes
 
     def _map_functions(self, dirty_nodes):
@@ -465,6 +646,7 @@ class DatabaseCoverage(object):
 
             # mark this node as executed in the function level mappping
             function_coverage.mark_node(node_coverage)
+            node_coverage.function_address = function_metadata.address
             dirty_functions[function_metadata.address] = function_coverage
 
             # end of nodes loop
@@ -476,10 +658,20 @@ class DatabaseCoverage(object):
         """
         Unmap all mapped data.
         """
-        self._unmapped_data = set(self._hitmap.keys())
-        self._unmapped_data.add(idaapi.BADADDR)
+        self._unmapped_data = self._hitmap.viewkeys()
         self.nodes     = {}
         self.functions = {}
+        self._dirty_functions = {}
+
+    def _find_nodes(self, addresses):
+        """
+        Find the addresses of the database nodes containing the given addresses.
+
+        The given addresses must be sorted.
+        """
+        node_addresses = self._metadata.node_addresses
+        runs = self._metadata.iter_node_runs(addresses)
+        return [node_addresses[node_index] for node_index, _, _ in runs if node_index >= 0]
 
     def _unmap_delta(self, delta):
         """
@@ -494,6 +686,16 @@ class DatabaseCoverage(object):
         self._unmap_nodes(itertools.chain(delta.nodes_removed, delta.nodes_modified))
         self._unmap_functions(delta.functions_removed)
 
+        #
+        # functions that gained or lost nodes need to be re-finalized, even if
+        # none of the nodes that they have coverage in have changed
+        #
+
+        for function_address in delta.functions_modified:
+            function_coverage = self.functions.get(function_address, None)
+            if function_coverage:
+                self._dirty_functions[function_address] = function_coverage
+
     def _unmap_nodes(self, node_addresses):
         """
         Unmap any data associated with a given list of node addresses.
@@ -506,6 +708,8 @@ class DatabaseCoverage(object):
         # mapping so we can selectively regenerate their coverage later.
         #
 
+        unmapped_addresses = set()
+
         for node_address in node_addresses:
 
             #
@@ -517,17 +721,46 @@ class DatabaseCoverage(object):
             if not node_coverage:
                 continue
 
+            #
             # the node was found, unmap any of its tracked coverage blocks
-            self._unmapped_data.update(
-                node_coverage.executed_instructions.viewkeys()
+            # that still have hits in the hitmap
+            #
+
+            unmapped_addresses.update(
+                address for address in node_coverage.executed_instructions
+                if address in self._hitmap
             )
 
+            #
+            # remove the node from the function that holds it. if that leaves
+            # the function without any executed nodes, the function coverage
+            # is dropped. otherwise it will need to be re-finalized.
+            #
+
+            function_address = node_coverage.function_address
+            function_coverage = self.functions.get(function_address, None)
+            if not function_coverage:
+                continue
+
+            function_coverage.unmark_node(node_coverage)
+
+            if function_coverage.nodes:
+                self._dirty_functions[function_address] = function_coverage
+            else:
+                del self.functions[function_address]
+                self._dirty_functions.pop(function_address, None)
+
+        # merge the newly unmapped addresses into the unmapped data
+        if unmapped_addresses:
+            self._unmapped_data |= AddressSet(unmapped_addresses)
+
     def _unmap_functions(self, function_addresses):
         """
         Unmap any data associated with a given list of function addresses.
         """
         for function_address in function_addresses:
             self.functions.pop(function_address, None)
+            self._dirty_functions.pop(function_address, None)
 
 #------------------------------------------------------------------------------
 # Function Level Coverage
@@ -597,6 +830,12 @@ class FunctionCoverage(object):
         """
         self.nodes[node_coverage.address] = node_coverage
 
+    def unmark_node(self, node_coverage):
+        """
+        Unmark the given node address as executed.
+        """
+        self.nodes.pop(node_coverage.address, None)
+
     def finalize(self):
         """
         Finalize coverage data for use.
@@ -635,7 +874,10 @@ class NodeCoverage(object):
     def __init__(self, node_address, database=None):
         self._database = database
         self.address = node_address
-        self.executed_instructions = {}
+        self.executed_instructions = CompactHitmap()
+
+        # the function this node was mapped to
+        self.function_address = None
 
     #--------------------------------------------------------------------------
     # Properties
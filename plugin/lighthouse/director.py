@@ -1,12 +1,13 @@
 import time
 import string
+import operator
 import logging
 import weakref
 import threading
 import collections
 
 from lighthouse.util import *
-from lighthouse.metadata import DatabaseMetadata, MetadataDelta
+from lighthouse.metadata import DatabaseMetadata, MetadataDelta, MetadataHooks
 from lighthouse.coverage import DatabaseCoverage
 from lighthouse.composer.parser import *
 
@@ -27,6 +28,8 @@ SHORTHAND_ALIASES = set([AGGREGATE_ALIAS]) | set(ASCII_SHORTHAND)
 
 RESERVED_NAMES = SHORTHAND_ALIASES | SPECIAL_NAMES
 
+COMMUTATIVE_OPERATORS = set([operator.or_, operator.and_, operator.xor])
+
 #------------------------------------------------------------------------------
 # The Coverage Director
 #------------------------------------------------------------------------------
@@ -176,6 +179,76 @@ class CoverageDirector(object):
         self._coverage_modified_callbacks = []
         self._coverage_created_callbacks  = []
         self._coverage_deleted_callbacks  = []
+        self._function_renamed_callbacks  = []
+
+        #----------------------------------------------------------------------
+        # Metadata Updates
+        #----------------------------------------------------------------------
+        #
+        #   The database metadata would go stale as soon as the user defines,
+        #   undefines, or modifies functions. To avoid this, we subscribe to
+        #   IDB events and queue the addresses of any affected functions.
+        #
+        #   A worker thread re-collects the metadata for just these functions,
+        #   and re-maps the coverage affected by the resulting metadata delta.
+        #
+        #   The same worker maps the loaded coverage to the metadata deltas
+        #   streamed by a metadata refresh (see _metadata_collected), which
+        #   keeps the mapping off of the main thread.
+        #
+
+        self._metadata_queue = Queue.Queue()
+        self._metadata_worker = threading.Thread(
+            target=self._async_update_metadata,
+            name="UpdateMetadata"
+        )
+        self._metadata_worker.daemon = True
+        self._metadata_worker.start()
+
+        self._metadata_hooks = MetadataHooks(
+            self._metadata_queue.put,
+            self._function_renamed
+        )
+        self._metadata_hooks.hook()
+
+        #
+        # coverage may now be mapped from the metadata workers while the user
+        # loads or deletes coverage on the main thread. this lock serializes
+        # any (re)mapping of the coverage sets maintained by the director.
+        #
+        # it is the lock that every change to the metadata is made under, so
+        # the metadata can not change while coverage is mapped against it
+        #
+
+        self._mapping_lock = self._database_metadata.lock
+
+        # the last time listeners were notified of streamed metadata
+        self._last_stream_notify = 0
+
+        #
+        # extended coverage is notified after a short delay, by a timer that
+        # runs on the main thread (see _notify_coverage_modified_later). the
+        # director is created on the main thread, so the timer lives there
+        #
+
+        self._deferred_notify = QtCore.QTimer()
+        self._deferred_notify.setSingleShot(True)
+        self._deferred_notify.timeout.connect(self._notify_deferred)
+        self._deferred_pending = False
+        self._deferred_notify_lock = threading.Lock()
+
+    def terminate(self):
+        """
+        Cleanup & terminate the director.
+        """
+        self._metadata_hooks.unhook()
+
+        # drop any pending notification of extended coverage
+        self._deferred_notify.stop()
+
+        # signal the worker threads to exit
+        self._metadata_queue.put(None)
+        self._ast_queue.put(None)
 
     #--------------------------------------------------------------------------
     # Properties
@@ -251,6 +324,43 @@ class CoverageDirector(object):
         """
         self._notify_callback(self._coverage_modified_callbacks)
 
+    def _notify_coverage_modified_later(self):
+        """
+        Notify listeners of a coverage modification event, after a short delay.
+
+        Any further notifications requested in the meantime are coalesced
+        into the pending one.
+        """
+
+        with self._deferred_notify_lock:
+            if self._deferred_pending:
+                return
+            self._deferred_pending = True
+
+        self._start_deferred_notify()
+
+    @idafast
+    def _start_deferred_notify(self):
+        """
+        Start the timer of a deferred notification (on the main thread).
+        """
+
+        # the time (milliseconds) to wait for coverage modifications to settle
+        NOTIFY_DELAY = 500
+
+        self._deferred_notify.start(NOTIFY_DELAY)
+
+    def _notify_deferred(self):
+        """
+        Internal timer callback of _notify_coverage_modified_later().
+        """
+
+        # modifications made while listeners are notified will notify again
+        with self._deferred_notify_lock:
+            self._deferred_pending = False
+
+        self._notify_coverage_modified()
+
     def coverage_created(self, callback):
         """
         Subscribe a callback for coverage creation events.
@@ -275,6 +385,18 @@ class CoverageDirector(object):
         """
         self._notify_callback(self._coverage_deleted_callbacks) # TODO: send list of names deleted?
 
+    def function_renamed(self, callback):
+        """
+        Subscribe a callback for function rename events.
+        """
+        self._register_callback(self._function_renamed_callbacks, callback)
+
+    def _notify_function_renamed(self):
+        """
+        Notify listeners of a function rename event.
+        """
+        self._notify_callback(self._function_renamed_callbacks)
+
     def _register_callback(self, callback_list, callback):
         """
         Internal callback registration.
@@ -293,6 +415,7 @@ class CoverageDirector(object):
         # register the callback
         callback_list.append(callback_ref)
 
+    @idafast
     def _notify_callback(self, callback_list):
         """
         Internal callback notification.
@@ -300,11 +423,16 @@ class CoverageDirector(object):
         The given list is expected to consist of all items registered to the
         same type of callback.
 
+        Coverage can be loaded, mapped, and merged by worker threads, but
+        the listeners are free to touch the UI. So callbacks are always run
+        on the main thread, no matter which thread raised the notification.
+
          eg:
            self._coverage_switched_callbacks
            self._coverage_modified_callbacks
            self._coverage_created_callbacks
            self._coverage_deleted_callbacks
+           self._function_renamed_callbacks
 
         Adapted from http://stackoverflow.com/a/21941670
         """
@@ -414,6 +542,108 @@ class CoverageDirector(object):
         else:
             self._notify_coverage_created()
 
+    def map_coverage(self, coverage_name, coverage_data):
+        """
+        Add (or update) coverage, deferring its merge into the aggregate.
+
+        The coverage is mapped and surfaced right away, so that it can be
+        viewed before the aggregate has been refreshed with it. This is used
+        to stream coverage into the director (see CoveragePipeline).
+
+        Returns the new coverage, and the data of the coverage it replaced
+        (or None). Both must be handed to merge_coverages() once ready.
+        """
+        assert not (coverage_name in RESERVED_NAMES)
+
+        #
+        # the coverage is mapped and surfaced under the mapping lock, so that
+        # metadata streamed in meanwhile is either mapped as part of the new
+        # coverage, or mapped to it after it has been surfaced
+        #
+
+        with self._mapping_lock:
+            new_coverage = self._build_coverage(coverage_data)
+            replaced_data = self._surface_coverage(coverage_name, new_coverage)
+
+        # notify any listeners that we have added or updated coverage
+        if replaced_data is None:
+            self._notify_coverage_created()
+        else:
+            self._notify_coverage_modified()
+
+        return (new_coverage, replaced_data)
+
+    def merge_coverages(self, new_coverages, replaced_hitmaps):
+        """
+        Merge coverage added by map_coverage() into the aggregate.
+        """
+        self._merge_aggregate(new_coverages, replaced_hitmaps)
+
+        # notify any listeners that the aggregate has changed
+        self._notify_coverage_modified()
+
+    def extend_coverage(self, coverage_name, coverage_data):
+        """
+        Add runtime data to loaded coverage, eg. as it is appended to a live log.
+
+        Only the given data is mapped, into the coverage and the aggregate.
+        Listeners are notified after a short delay, so that a stream of small
+        additions is not repainted one addition at a time.
+        """
+        with self._mapping_lock:
+            coverage = self._database_coverage[coverage_name]
+
+            # expand block data to the instructions it executed
+            if isinstance(coverage_data, BlockHitmap):
+                coverage_data = coverage_data.expand(self.metadata)
+
+            for database_coverage in [coverage, self.aggregate]:
+                database_coverage.add_data(coverage_data)
+                database_coverage.refresh_data(coverage_data)
+
+        # notify any listeners that coverage has changed, once things settle
+        self._notify_coverage_modified_later()
+
+    def _surface_coverage(self, coverage_name, new_coverage):
+        """
+        Surface mapped coverage under the given name, leaving the aggregate be.
+
+        The caller must hold the mapping lock. Returns the data of the
+        coverage it replaced, or None.
+        """
+        old_coverage = self._database_coverage.get(coverage_name, None)
+        self._database_coverage[coverage_name] = new_coverage
+
+        if old_coverage is not None:
+            logger.debug("Updating coverage %s" % coverage_name)
+            return old_coverage.data
+
+        # assign a shorthand alias (if available) to new coverage additions
+        logger.debug("Adding coverage %s" % coverage_name)
+        self._request_shorthand_alias(coverage_name)
+        return None
+
+    def _merge_aggregate(self, new_coverages, replaced_hitmaps):
+        """
+        Merge a batch of coverage into the aggregate with a single refresh.
+        """
+        if not (new_coverages or replaced_hitmaps):
+            return
+
+        # merge the hitmaps of the new coverage into one, in a single pass
+        merged_data = CompactHitmap.merge(x.data for x in new_coverages)
+
+        with self._mapping_lock:
+
+            # remove the data of any coverage replaced by this batch
+            if replaced_hitmaps:
+                self.aggregate.subtract_data(CompactHitmap.merge(replaced_hitmaps))
+
+            # add the merged data to the aggregate and refresh it (once)
+            self.aggregate.add_data(merged_data)
+            self.aggregate.update_metadata(self.metadata)
+            self.aggregate.refresh()
+
     def _update_coverage(self, coverage_name, new_coverage):
         """
         Internal add/update of coverage.
@@ -429,9 +659,10 @@ class CoverageDirector(object):
 
         if coverage_name in self.coverage_names:
             old_coverage = self._database_coverage[coverage_name]
-            self.aggregate.subtract_data(old_coverage.data)
-            self.aggregate.update_metadata(self.metadata)
-            self.aggregate.refresh()
+            with self._mapping_lock:
+                self.aggregate.subtract_data(old_coverage.data)
+                self.aggregate.update_metadata(self.metadata)
+                self.aggregate.refresh()
 
         #
         # this is the critical point where we actually integrate the newly
@@ -441,26 +672,27 @@ class CoverageDirector(object):
         self._database_coverage[coverage_name] = new_coverage
 
         #
-        # TODO/PERF:
+        # NOTE/PERF:
         #
-        #   If we are calling add_coverage 1000x times, we don't want to
-        #   refresh the aggregate set every time... we will want to
-        #   restructure things such that we can refresh once only after a
-        #   batch load
+        #   If we are adding coverage 1000x times, we don't want to refresh
+        #   the aggregate set every time... batch loads should go through
+        #   map_coverage() and merge_coverages(), which refresh it once.
         #
 
         # (re)-add the newly loaded/updated coverage to the aggregate set
-        self.aggregate.add_data(new_coverage.data)
-        self.aggregate.update_metadata(self.metadata)
-        self.aggregate.refresh()
+        with self._mapping_lock:
+            self.aggregate.add_data(new_coverage.data)
+            self.aggregate.update_metadata(self.metadata)
+            self.aggregate.refresh()
 
     def _build_coverage(self, coverage_data):
         """
         Build a new database coverage object from the given data.
         """
         new_coverage = DatabaseCoverage(coverage_data, self._palette)
-        new_coverage.update_metadata(self.metadata)
-        new_coverage.refresh()
+        with self._mapping_lock:
+            new_coverage.update_metadata(self.metadata)
+            new_coverage.refresh()
         return new_coverage
 
     def delete_coverage(self, coverage_name):
@@ -484,9 +716,10 @@ class CoverageDirector(object):
         coverage = self._database_coverage.pop(coverage_name)
         # TODO: check if there's any references to the coverage object here...
 
-        self.aggregate.subtract_data(coverage.data)
-        self.aggregate.update_metadata(self.metadata)
-        self.aggregate.refresh()
+        with self._mapping_lock:
+            self.aggregate.subtract_data(coverage.data)
+            self.aggregate.update_metadata(self.metadata)
+            self.aggregate.refresh()
 
         # notify any listeners that we have deleted coverage
         self._notify_coverage_deleted()
@@ -710,8 +943,8 @@ class CoverageDirector(object):
             # This 'hash' can be used to index into an LRU based cache that
             # holds compositions created by the AST evaluation process.
             #
-            # The 'hash' is actually computed as a product of the operator
-            # that would normally combine the two coverage sets.
+            # The 'hash' is actually computed from the operator, and the hashes
+            # of the two coverage sets that it would normally combine.
             #
             # For example, when computing compositions the logical operators
             # (eg |, &, ^), it does not matter which side of the equation the
@@ -724,18 +957,25 @@ class CoverageDirector(object):
             #      (A - B) != (B - A)
             #
             # So if we are being asked to compute a composition of (A | B),
-            # we first compute:
+            # we order the operands of the (commutative) operator by hash, and
+            # then compute:
             #
-            #      composition_hash = hash(A) | hash(B)
+            #      composition_hash = (operator, hash(A), hash(B))
             #
             # And use composition_hash to check an LRU cache for the complete
             # evaluation/composition of (A | B).
             #
-            # The possibility of collisions are generally higher with this
-            # form of 'hash', but I still expect them to be extremely rare.
+            # Collisions are unlikely, but possible. So the cache also holds
+            # the operands of each composition, and will only return a cached
+            # composition if its operands truly match the ones given.
             #
 
-            composition_hash = node.operator(op1.coverage_hash, op2.coverage_hash)
+            if node.operator in COMMUTATIVE_OPERATORS and \
+                op2.coverage_hash < op1.coverage_hash:
+                op1, op2 = op2, op1
+
+            composition_hash = (node.operator, op1.coverage_hash, op2.coverage_hash)
+            operands = (op1.coverage, op2.coverage)
 
             #
             # Evaluating an AST produces lots of 'transient' compositions. To
@@ -764,7 +1004,7 @@ class CoverageDirector(object):
             #
 
             # check the cache to see if this composition was recently computed
-            cached_coverage = self._composition_cache[composition_hash]
+            cached_coverage = self._composition_cache.get(composition_hash, operands)
 
             # if the composition was found in the cache, return that for speed
             if cached_coverage:
@@ -774,8 +1014,15 @@ class CoverageDirector(object):
             # using the collected components of the logical operation, we
             # compute the coverage mask defined by this TokenLogicOperator
             #
+            # NOTE/PERF:
+            #
+            #   the coverage masks are InstructionBitmaps over the ordinals of
+            #   the database instructions, so the operator is evaluated as a
+            #   bitwise operation on two longs rather than by hashing every
+            #   executed address (see util/hitmap.py)
+            #
 
-            coverage_mask = node.operator(op1.coverage, op2.coverage)
+            coverage_mask = node.operator(*operands)
 
             #
             # now that we have computed the requested coverage mask (bitmap),
@@ -786,7 +1033,7 @@ class CoverageDirector(object):
             new_composition = DatabaseCoverage(coverage_mask, self._palette)
 
             # cache & return the newly computed composition
-            self._composition_cache[composition_hash] = new_composition
+            self._composition_cache.put(composition_hash, operands, new_composition)
             return new_composition
 
         #
@@ -842,6 +1089,223 @@ class CoverageDirector(object):
         # return the computed coverage
         return output
 
+    #----------------------------------------------------------------------
+    # Metadata Updates
+    #----------------------------------------------------------------------
+
+    def _function_renamed(self, address, new_name):
+        """
+        Handle a function rename event from the database.
+        """
+        function_metadata = self.metadata.functions.get(address, None)
+        if not function_metadata:
+            return
+
+        function_metadata.name_changed(new_name)
+
+        # notify any listeners that a function name has changed
+        self._notify_function_renamed()
+
+    def _async_update_metadata(self):
+        """
+        Asynchronous metadata update worker loop.
+        """
+        logger.debug("Starting UpdateMetadata thread...")
+
+        # the time (seconds) to wait for a burst of events to settle
+        SETTLE_TIME = 0.5
+
+        while True:
+
+            # wait for the next function addresses to update (or metadata to map)
+            item = self._metadata_queue.get()
+
+            # signal to stop
+            if item is None:
+                break
+
+            # a metadata delta streamed by a refresh, map coverage to it
+            if isinstance(item, MetadataDelta):
+                self._map_metadata_delta(item)
+                continue
+
+            #
+            # database events tend to arrive in bursts (eg, undefining a range
+            # of code). we gather up the addresses of events until they settle
+            # so that the burst is handled as a single metadata update.
+            #
+            # streamed metadata deltas that arrive meanwhile are mapped right
+            # away, and do not hold off the settling of the events
+            #
+
+            pending = set(item)
+            settle_deadline = time.time() + SETTLE_TIME
+            while item is not None:
+                try:
+                    item = self._metadata_queue.get(timeout=max(0, settle_deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if isinstance(item, MetadataDelta):
+                    self._map_metadata_delta(item)
+                elif item is not None:
+                    pending.update(item)
+                    settle_deadline = time.time() + SETTLE_TIME
+
+            # update the metadata of the affected functions
+            self._update_metadata(pending)
+
+            # a stop was signaled while gathering events
+            if item is None:
+                break
+
+        # thread exit
+        logger.debug("Exiting UpdateMetadata thread...")
+
+    def _update_metadata(self, function_addresses):
+        """
+        Update the metadata of the given functions, and re-map coverage.
+        """
+
+        #
+        # if the metadata has not been collected yet, there is nothing to
+        # update. the first full refresh will collect these functions anyway
+        #
+
+        if not self.metadata.functions:
+            return
+
+        #
+        # re-collect the metadata for just the affected functions. this can
+        # overlap a running refresh, as every change to the metadata is made
+        # under its lock
+        #
+
+        delta = self.metadata.update_functions(function_addresses)
+        if not delta:
+            return
+
+        logger.debug(
+            "Metadata updated for %u functions (%u nodes changed)" % \
+            (
+                len(function_addresses),
+                len(delta.nodes_added) + len(delta.nodes_removed) + len(delta.nodes_modified)
+            )
+        )
+
+        #
+        # cached compositions were mapped against the stale metadata, it is
+        # simpler to let them be re-computed than to re-map them all here
+        #
+
+        self._composition_cache = CompositionCache()
+
+        # re-map just the coverage affected by the metadata delta
+        self._refresh_database_coverage(delta)
+
+        # notify any listeners that coverage may have changed
+        self._notify_coverage_modified()
+
+    def refresh_metadata(self, progress_callback=None):
+        """
+        Refresh the database metadata (asynchronously).
+
+        The loaded coverage is mapped to the metadata as it is collected,
+        rather than after the refresh has completed. Returns the future of
+        the metadata refresh (see DatabaseMetadata.refresh).
+        """
+        return self.metadata.refresh(
+            progress_callback=progress_callback,
+            delta_callback=self._metadata_collected
+        )
+
+    def _metadata_collected(self, delta):
+        """
+        Queue the loaded coverage to be mapped to freshly collected metadata.
+
+        This is called from the metadata refresh worker, for each batch of
+        functions it collects. The coverage is mapped by the UpdateMetadata
+        worker, so that neither the refresh nor the main thread wait on it.
+        """
+        self._metadata_queue.put(delta)
+
+    def _map_metadata_delta(self, delta):
+        """
+        Map the loaded coverage to freshly collected metadata.
+        """
+
+        # the time (seconds) between notifications of streamed coverage
+        NOTIFY_INTERVAL = 0.5
+
+        # if there is no loaded coverage, there is nothing to map
+        if not self.coverage_names:
+            return
+
+        #
+        # cached compositions were mapped against the partial metadata, it is
+        # simpler to let them be re-computed than to re-map them all here
+        #
+
+        self._composition_cache = CompositionCache()
+
+        # map the coverage that falls within the freshly collected functions
+        self._refresh_database_coverage(delta)
+
+        #
+        # the metadata arrives in many small batches. rather than having the
+        # painter & overview refresh for every one of them, listeners are
+        # notified periodically (and once more when the refresh completes).
+        # the listeners themselves are always run on the main thread
+        #
+
+        now = time.time()
+        if now - self._last_stream_notify < NOTIFY_INTERVAL:
+            return
+        self._last_stream_notify = now
+
+        # notify any listeners that coverage may have changed
+        self._notify_coverage_modified()
+
+    def await_metadata(self, future):
+        """
+        Re-map the loaded coverage once a metadata refresh completes.
+
+        Coverage may be mapped while the metadata is still being collected
+        in the background (see DatabaseMetadata.prioritize). Once the rest
+        of the metadata arrives, the coverage is re-mapped in the background.
+        """
+        worker = threading.Thread(
+            target=self._async_await_metadata,
+            args=(future,),
+            name="AwaitMetadata"
+        )
+        worker.daemon = True
+        worker.start()
+
+    def _async_await_metadata(self, future):
+        """
+        Internal asynchronous worker of await_metadata().
+        """
+
+        # wait for the metadata refresh to complete
+        if not future.get():
+            logger.debug("Metadata refresh aborted, coverage will not be re-mapped")
+            return
+
+        logger.debug("Metadata refresh completed, re-mapping coverage")
+
+        #
+        # cached compositions were mapped against the partial metadata, it is
+        # simpler to let them be re-computed than to re-map them all here
+        #
+
+        self._composition_cache = CompositionCache()
+
+        # map any coverage that fell within the newly collected metadata
+        self._refresh_database_coverage(None)
+
+        # notify any listeners that coverage may have changed
+        self._notify_coverage_modified()
+
     #----------------------------------------------------------------------
     # Refresh
     #----------------------------------------------------------------------
@@ -889,11 +1353,38 @@ class CoverageDirector(object):
         """
         logger.debug("Refreshing database coverage mappings")
 
-        for name in self.all_names:
-            logger.debug(" - %s" % name)
-            coverage = self.get_coverage(name)
-            coverage.update_metadata(self.metadata, delta)
-            coverage.refresh()
+        with self._mapping_lock:
+            expanded = False
+
+            for name in self.coverage_names:
+                logger.debug(" - %s" % name)
+                coverage = self.get_coverage(name)
+                data = coverage.data
+                coverage.update_metadata(self.metadata, delta)
+                coverage.refresh(delta)
+
+                # coverage held as blocks may have been expanded anew
+                expanded |= coverage.data is not data
+
+            #
+            # the aggregate was merged from the instructions that the loaded
+            # coverage had expanded to. if any of it has been re-expanded, the
+            # aggregate is rebuilt from scratch rather than patched up
+            #
+
+            if expanded:
+                logger.debug("Rebuilding the aggregate")
+                merged_data = CompactHitmap.merge(x.data for x in self._database_coverage.itervalues())
+                aggregate = DatabaseCoverage(merged_data, self._palette)
+                aggregate.update_metadata(self.metadata)
+                aggregate.refresh()
+                self._special_coverage[AGGREGATE] = aggregate
+
+            for name in self.special_names:
+                logger.debug(" - %s" % name)
+                coverage = self.get_coverage(name)
+                coverage.update_metadata(self.metadata, delta)
+                coverage.refresh(delta)
 
     def _request_shorthand_alias(self, coverage_name):
         """
@@ -944,39 +1435,56 @@ DEFAULT_CACHE_CAPACITY = 30
 class CompositionCache(object):
     """
     A simple LRU cache to hold coverage compositions.
+
+    Cache entries are keyed by a composition hash, but each entry also holds
+    the operands that produced its composition. A lookup will only hit if
+    the given operands are equal to those of the entry, so a hash collision
+    can never return the wrong composition.
     """
 
     def __init__(self, capacity=DEFAULT_CACHE_CAPACITY):
         self._cache = collections.OrderedDict()
         self._capacity = capacity
 
-    def __getitem__(self, key):
+    def get(self, key, operands):
         """
-        Get an entry from the cache.
+        Get a composition from the cache, verifying its operands.
         """
-        result = self._cache.pop(key, None)
+        entry = self._cache.pop(key, None)
+
+        # cache miss
+        if not entry:
+            return None
 
         # cache hit, raise priority of this item
-        if result:
-            self._cache[key] = result
+        self._cache[key] = entry
 
-        # return the cache entry (or None)
-        return result
+        #
+        # the composition hash matched, but the operands did not. this is a
+        # hash collision, so the cached composition is not the one requested
+        #
+
+        cached_operands, composition = entry
+        if not all(x == y for x, y in zip(cached_operands, operands)):
+            logger.debug("Composition cache collision on %r" % (key,))
+            return None
 
-    def __setitem__(self, key, value):
+        # return the cached composition
+        return composition
+
+    def put(self, key, operands, composition):
         """
-        Update the cache with the given entry.
+        Update the cache with the given composition.
         """
-        result = self._cache.pop(key, None)
-
-        # item is already in the cache, touch it.
-        if result:
-            self._cache[key] = result
-            return
+        self._cache.pop(key, None)
 
         # if the cache is full, evict the entry oldest entry
         if len(self._cache) > self._capacity:
             self._cache.popitem(False)
 
-        # insert the new cache entry
-        self._cache[key] = value
+        #
+        # insert the new cache entry. on a hash collision, this replaces the
+        # colliding entry with the composition that was most recently used
+        #
+
+        self._cache[key] = (operands, composition)
@@ -1,10 +1,18 @@
+import gc
+import os
 import time
+import array
+import zlib
 import Queue
 import bisect
+import itertools
+import operator
 import ctypes
+import marshal
 import logging
 import threading
 
+import idc
 import idaapi
 import idautils
 
@@ -46,6 +54,11 @@ logger = logging.getLogger("Lighthouse.Metadata")
 #       This will be negligible for small-medium sized databases, but may
 #       still be jarring for larger databases.
 #
+#       To soften this, collected metadata is persisted to a cache file that
+#       sits beside the database (see 'Metadata Cache' below). Reopening the
+#       database will load the cache, and only re-collect the functions that
+#       appear to have changed since it was written.
+#
 #    Ultimately, this model provides us responsive user experience at the
 #    expense of the ocassional inaccuracies that can be corrected by a
 #    reasonably low cost refresh.
@@ -56,6 +69,12 @@ logger = logging.getLogger("Lighthouse.Metadata")
 # Database Level Metadata
 #------------------------------------------------------------------------------
 
+# the main thread time that may be spent collecting metadata in one slice
+SLICE_TIME = 0.025
+
+# the time to yield the main thread back to IDA between slices
+YIELD_TIME = 0.0015
+
 class DatabaseMetadata(object):
     """
     Fast access database level metadata cache.
@@ -63,9 +82,6 @@ class DatabaseMetadata(object):
 
     def __init__(self):
 
-        # database defined instructions
-        self.instructions = {}
-
         # database defined nodes (basic blocks)
         self.nodes = {}
 
@@ -76,16 +92,89 @@ class DatabaseMetadata(object):
         #self.segments = {}
         #self._segment_addresses = {}
 
+        #
+        # the metadata is changed by the refresh worker and the hooks (on
+        # behalf of the user) while coverage is mapped against it by other
+        # threads. every change to the metadata is made under this lock,
+        # which the director also holds while it maps coverage
+        #
+
+        self.lock = threading.RLock()
+
         # lookup list members
         self._stale_lookup = False
         self._last_node = []           # TODO/HACK: blank iterable for now
-        self._node_addresses = []
-        self._function_addresses = []
+        self._lookup = _LookupIndex()
+
+        #
+        # database defined instructions, as parallel (address, size) arrays
+        # sorted by address. these are built on demand from the instructions
+        # of each node (see instruction_addresses)
+        #
+
+        self._stale_instructions = False
+        self._instructions = (address_array(), instruction_size_array())
+
+        # breaks between adjacent instructions, keyed by the instruction array
+        self._instruction_breaks = (None, array.array("l"))
 
         # asynchrnous metadata collection thread
         self._refresh_worker = None
         self._stop_threads = False
 
+        # the futures of everyone waiting on the running refresh
+        self._refresh_lock = threading.Lock()
+        self._refresh_futures = []
+
+        # the collector used by the running refresh (see prioritize)
+        self._collector = None
+
+        # the key (and path) of the persistent metadata cache, if it is to be saved
+        self._cache_key = None
+        self._cache_path = None
+        self._cache_stale = False
+        self._cache_save_lock = threading.Lock()
+
+    #--------------------------------------------------------------------------
+    # Properties
+    #--------------------------------------------------------------------------
+
+    @property
+    def instruction_addresses(self):
+        """
+        The sorted address array of all database defined instructions.
+
+        The index of an instruction address in this array is its 'ordinal'.
+        Ordinals are dense, and are used by coverage sets to encode the
+        instructions they execute as a bitmap (see InstructionBitmap).
+
+        The array is rebuilt (as a new object) whenever the instructions
+        change, so an instruction bitmap remains valid for as long as its
+        ordinals array 'is' the one returned by this property.
+        """
+        return self._refresh_instructions()[0]
+
+    @property
+    def instruction_sizes(self):
+        """
+        The sizes of all database defined instructions, by ordinal.
+        """
+        return self._refresh_instructions()[1]
+
+    @property
+    def node_addresses(self):
+        """
+        The sorted array of all database defined node (basic block) addresses.
+        """
+        return self._refresh_lookup().node_addresses
+
+    @property
+    def function_addresses(self):
+        """
+        The sorted array of all database defined function addresses.
+        """
+        return self._refresh_lookup().function_addresses
+
     #--------------------------------------------------------------------------
     # Providers
     #--------------------------------------------------------------------------
@@ -135,100 +224,292 @@ class DatabaseMetadata(object):
         #  no overhead to the 'get_node' call.
         #
 
-        self._refresh_lookup()
+        lookup = self._refresh_lookup()
 
         #
-        # use the lookup lists to do a 'fuzzy' lookup, locating the index of
-        # the closest known (cached) node address (rounding down)
+        # use the node interval index to do a 'fuzzy' lookup, locating the
+        # closest known (cached) node address (rounding down)
         #
 
-        node_index = bisect.bisect_right(self._node_addresses, address) - 1
+        node_index = _find_interval(lookup.node_addresses, lookup.node_ends, address)
 
         #
-        # if the identified node contains our target address, it is a match
+        # if there was no node whose interval contains the target address,
+        # there are no second chances. the address simply does not exist
+        # within a defined node.
         #
 
-        try:
-            node = self.nodes[self._node_addresses[node_index]]
-            if address in node:
-                self._last_node = node
-                return node
-        except (IndexError, KeyError):
-            pass
+        if node_index < 0:
+            raise ValueError("Given address does not fall within a known node")
 
-        #
-        # if the selected node was not a match, there are no second chances.
-        # the address simply does not exist within a defined node.
-        #
+        # the identified node contains our target address, it is a match
+        node = self.nodes.get(lookup.node_addresses[node_index], None)
+        if not node:
+            raise ValueError("Given address does not fall within a known node")
+
+        self._last_node = node
+        return node
+
+    def get_function(self, address):
+        """
+        Get the function for a given address.
+
+        This function provides fast lookup of function metadata for an
+        arbitrary address (ea), including addresses within function tails.
+
+        If the address does not fall within a known function, a ValueError
+        is raised.
+        """
+        lookup = self._refresh_lookup()
+
+        # locate the function chunk containing the target address
+        chunk_index = _find_interval(lookup.chunk_addresses, lookup.chunk_ends, address)
+        if chunk_index < 0:
+            raise ValueError("Given address does not fall within a known function")
 
-        raise ValueError("Given address does not fall within a known node")
+        function = self.functions.get(lookup.chunk_owners[chunk_index], None)
+        if not function:
+            raise ValueError("Given address does not fall within a known function")
 
-    def flatten_blocks(self, basic_blocks):
+        return function
+
+    def resolve_addresses(self, addresses):
+        """
+        Resolve a sorted array of addresses to node & function ids, in bulk.
+
+        Returns a (node_ids, function_ids) tuple of arrays, parallel to the
+        given addresses. A node id is an index into 'node_addresses', and a
+        function id is an index into 'function_addresses'. Addresses that do
+        not fall within a known node (or function) resolve to an id of -1.
+        """
+        lookup = self._refresh_lookup()
+
+        node_ids = array.array("l", [-1]) * len(addresses)
+        function_ids = array.array("l", [-1]) * len(addresses)
+
+        # resolve runs of addresses to the node containing them
+        runs = _iter_interval_runs(lookup.node_addresses, lookup.node_ends, addresses)
+        for node_index, start, end in runs:
+            if node_index >= 0:
+                node_ids[start:end] = array.array("l", [node_index]) * (end - start)
+
+        # resolve runs of addresses to the function (chunk) containing them
+        runs = _iter_interval_runs(lookup.chunk_addresses, lookup.chunk_ends, addresses)
+        for chunk_index, start, end in runs:
+            if chunk_index < 0:
+                continue
+            function_index = bisect.bisect_left(
+                lookup.function_addresses,
+                lookup.chunk_owners[chunk_index]
+            )
+            function_ids[start:end] = array.array("l", [function_index]) * (end - start)
+
+        return (node_ids, function_ids)
+
+    def iter_node_runs(self, addresses):
+        """
+        Walk a sorted array of addresses against the node interval index.
+
+        Yields (node_index, start, end) tuples, such that each run of addresses
+        in addresses[start:end] falls within the node at node_index of the
+        'node_addresses' array. Runs that do not fall in a node yield -1.
         """
-        Flatten a list of basic blocks (address, size) to instruction addresses.
+        lookup = self._refresh_lookup()
+        return _iter_interval_runs(lookup.node_addresses, lookup.node_ends, addresses)
 
-        This function provides a way to convert a list of (address, size) basic
-        block entries into a list of individual instruction (or byte) addresses
-        based on the current metadata.
+    def flatten_blocks(self, starts, sizes, counts=None):
+        """
+        Flatten basic blocks to a hitmap of instruction addresses.
+
+        This function provides a way to convert parallel (starts, sizes) basic
+        block arrays into the individual instruction (or byte) addresses they
+        execute, based on the current metadata.
 
         If no corresponding metadata instruction can be found for a given
         address while walking the basic block ranges, the current address being
-        flattened is saved as a 'byte address' to the output list.
+        flattened is saved as a 'byte address' to the output.
 
         A byte address is basically an address that points to one 'undefined
         byte', such as a byte in an 'undefined instruction'
+
+        If an array of block hit counts is given, each block is counted that
+        many times. Otherwise, each block is counted once.
+
+        Returns a CompactHitmap, whose sorted address array holds every
+        flattened address. Addresses covered by more than one block are
+        counted once for each block that covers them.
         """
-        output = []
+        instruction_addresses, instruction_sizes = self._refresh_instructions()
+        run_breaks = self._refresh_instruction_breaks(instruction_addresses, instruction_sizes)
+        break_count = len(run_breaks)
+        instruction_count = len(instruction_addresses)
 
-        # loop through every given basic block (input)
-        for address, size in basic_blocks:
-            end_address = address + size
+        #
+        # walking each block one instruction at a time is far too slow for
+        # traces with millions of blocks. instead, we bisect the instruction
+        # address array for the range of instruction ordinals that fall in
+        # each block, and count the blocks that cover each ordinal with a
+        # 'difference' array: +1 where a range starts, -1 where it ends.
+        #
+        # this only holds if the block is tiled end to end by known, adjacent
+        # instructions. blocks that start mid-instruction, or cover undefined
+        # bytes, fall back to being walked (see _walk_block)
+        #
+
+        deltas = array.array("l", [0]) * (instruction_count + 1)
+
+        # the hit counts of addresses that had to be walked (address --> hits)
+        walked = {}
+
+        bisect_left = bisect.bisect_left
+        bisect_right = bisect.bisect_right
+        hit_counts = counts if counts is not None else itertools.repeat(1)
+        for start, size, hits in itertools.izip(starts, sizes, hit_counts):
+            end = start + size
+            first = bisect_left(instruction_addresses, start)
+            last = bisect_left(instruction_addresses, end, first, min(first + size, instruction_count)) - 1
+
+            # the next break in adjacency (if any) after the first instruction
+            next_break = bisect_right(run_breaks, first)
+
+            # the block is made entirely of a run of adjacent instructions
+            if first <= last \
+                and instruction_addresses[first] == start \
+                and (next_break == break_count or run_breaks[next_break] > last) \
+                and instruction_addresses[last] + instruction_sizes[last] >= end:
+                deltas[first] += hits
+                deltas[last + 1] -= hits
+
+            # the block touches undefined bytes, walk it the slow way
+            else:
+                block_addresses = []
+                _walk_block(instruction_addresses, instruction_sizes, start, end, first, block_addresses)
+                for address in block_addresses:
+                    walked[address] = walked.get(address, 0) + hits
 
-            # loop through the byte range defined by the basic block
-            while address < end_address:
+        #
+        # a running sum over the difference array yields the number of blocks
+        # covering each instruction ordinal. the sum only changes where the
+        # difference array is non-zero, so we step from one such ordinal to
+        # the next, slicing out whole spans of executed instructions at once.
+        #
+        # the executed ordinals (and their counts) are emitted in order, so
+        # no sorting is required
+        #
 
-                # save the current address as an instruction address
-                output.append(address)
+        addresses = address_array()
+        counts = count_array()
 
-                # move forward to the next instruction (or byte) address
-                address += self.instructions.get(address, 1)
+        hits = 0
+        previous = 0
+        for ordinal in itertools.compress(xrange(instruction_count + 1), deltas):
+            if hits:
+                addresses.extend(instruction_addresses[previous:ordinal])
+                counts.extend(count_array([hits]) * (ordinal - previous))
+            hits += deltas[ordinal]
+            previous = ordinal
 
-        # return the list of addresses
-        return output
+        hitmap = CompactHitmap.from_arrays(addresses, counts)
+
+        # fold in any addresses that had to be walked
+        if walked:
+            walked_addresses = address_array(sorted(walked))
+            walked_counts = count_array([walked[address] for address in walked_addresses])
+            walked_hitmap = CompactHitmap.from_arrays(walked_addresses, walked_counts)
+            hitmap = CompactHitmap.merge([hitmap, walked_hitmap])
+
+        return hitmap
 
     #--------------------------------------------------------------------------
     # Refresh
     #--------------------------------------------------------------------------
 
-    def refresh(self, function_addresses=None, progress_callback=None):
+    def refresh(self, function_addresses=None, progress_callback=None, delta_callback=None):
         """
         Refresh the entire database metadata (asynchronously)
+
+        If given, the delta_callback is called (from the refresh worker) with
+        a MetadataDelta for each batch of function metadata as it is collected.
+
+        If a refresh is already running, no new refresh is started. Instead,
+        the functions of this refresh are merged into the running one, and the
+        returned future receives the result of the running refresh.
         """
-        assert self._refresh_worker == None, 'Refresh already running'
         result_queue = Queue.Queue()
 
+        #
+        # NOTE: the metadata can be in use by a mapping thread right now, so
+        # it is not changed here. any changes made by the refresh (including
+        # those found below) are made by the refresh worker, under the lock
+        #
+
+        removed_functions = set()
+        cached_functions = {}
+
         #
         # if no (function) addresses were specified by the caller, we proceed
         # with a complete metadata refresh.
         #
 
-        if function_addresses is None:
+        full_refresh = function_addresses is None
+        if full_refresh:
 
             # retrieve a full function address list from the underlying database
             function_addresses = list(idautils.Functions())
 
             #
-            # immediately drop function entries that are no longer present in the
-            # function address list we just pulled from the database
+            # drop function entries that are no longer present in the function
+            # address list we just pulled from the database
             #
 
             removed_functions = self.functions.viewkeys() - set(function_addresses)
-            for function_address in removed_functions:
-                del self.functions[function_address]
 
-            # schedule a deferred lookup list refresh if we deleted any functions
-            if removed_functions:
-                self._stale_lookup = True
+            #
+            # NOTE: the cache is saved by the refresh worker, so its path must
+            # be resolved here, while we are still on the main thread
+            #
+
+            self._cache_key = get_metadata_cache_key()
+            self._cache_path = get_metadata_cache_path()
+
+        with self._refresh_lock:
+
+            #
+            # the user can request a refresh (eg, by loading more coverage)
+            # while the last one is still running. rather than starting
+            # another, the functions of this refresh are merged into the
+            # running one, and the caller simply waits on it as well.
+            #
+            # a full refresh adds the functions the running refresh does not
+            # know of yet (and those that were removed, so they are dropped).
+            # the functions of a partial refresh are collected again, even if
+            # the running refresh has already collected them
+            #
+
+            worker, collector = self._refresh_worker, self._collector
+            if worker and worker.is_alive() and collector:
+
+                if full_refresh:
+                    merged = collector.add_functions(list(removed_functions) + function_addresses)
+                else:
+                    merged = collector.add_functions(function_addresses, recollect=True)
+
+                if merged:
+                    logger.debug("Refresh already running, merged into it")
+                    self._cache_stale |= full_refresh
+                    self._refresh_futures.append(result_queue)
+                    return result_queue
+
+        #
+        # on the first full refresh of the metadata, we try to load any
+        # previously collected metadata from the persistent cache. only
+        # the functions that could not be loaded will need collection
+        #
+
+        if full_refresh:
+            self._cache_stale = True
+            if not self.functions:
+                cached_functions, function_addresses = self._load_cache(function_addresses)
 
         #
         # reset the async abort/stop flag that can be used used to cancel the
@@ -237,15 +518,29 @@ class DatabaseMetadata(object):
 
         self._stop_threads = False
 
+        #
+        # the collector is created before the refresh worker is started so
+        # that callers can prioritize functions as soon as we return
+        #
+
+        collector = MetadataCollector(function_addresses)
+        result_queues = [result_queue]
+
         #
         # kick off an asynchronous metadata collection task
         #
 
-        self._refresh_worker = threading.Thread(
+        worker = threading.Thread(
             target=self._async_refresh,
-            args=(result_queue, function_addresses, progress_callback,)
+            args=(collector, result_queues, removed_functions, cached_functions, progress_callback, delta_callback,)
         )
-        self._refresh_worker.start()
+
+        with self._refresh_lock:
+            self._collector = collector
+            self._refresh_futures = result_queues
+            self._refresh_worker = worker
+
+        worker.start()
 
         #
         # immediately return a queue to the user that will shepard the future
@@ -254,6 +549,88 @@ class DatabaseMetadata(object):
 
         return result_queue
 
+    def prioritize(self, ranges):
+        """
+        Collect the functions within the given [start, end) address ranges first.
+
+        During a refresh, the functions within the given ranges will be
+        collected ahead of the rest of the database. This lets a caller
+        (eg, the coverage loader) start on the functions it cares about
+        without waiting for the metadata of the entire database.
+
+        Returns a queue that will receive an item once the metadata for
+        these functions is available, much like the future of refresh().
+        """
+        result_queue = Queue.Queue()
+
+        #
+        # the collector (if any) can be ripped away by the refresh worker at
+        # any time. if there is no refresh running, or it is just finishing
+        # up, the metadata for these functions is already as good as it gets
+        #
+
+        collector = self._collector
+        if not (collector and collector.prioritize(ranges, result_queue)):
+            result_queue.put(self)
+
+        return result_queue
+
+    def update_functions(self, function_addresses):
+        """
+        Re-collect the metadata of specific functions (synchronously).
+
+        This is used to keep the metadata in sync with changes made to the
+        database by the user (see MetadataHooks). Addresses that no longer
+        start a defined function will have their metadata removed.
+
+        Returns a MetadataDelta describing the changes to the metadata.
+        """
+        function_addresses = sorted(function_addresses)
+
+        #
+        # collect the latest metadata for these functions from the database.
+        # this is done on the main thread, so it must not be done under the
+        # metadata lock (which the main thread may be waiting on)
+        #
+
+        fresh_metadata = collect_function_metadata(function_addresses)
+
+        with self.lock:
+
+            # snapshot the current metadata of the functions to be updated
+            old_functions = {}
+            for function_address in function_addresses:
+                function_metadata = self.functions.get(function_address, None)
+                if function_metadata:
+                    old_functions[function_address] = function_metadata
+
+            # remove the functions that no longer exist, and update the rest
+            self._remove_functions(old_functions.viewkeys() - fresh_metadata.viewkeys())
+            self._update_functions(fresh_metadata)
+            self._refresh_lookup()
+
+        # compute the delta of just the updated functions
+        delta = MetadataDelta.from_functions(fresh_metadata, old_functions)
+
+        #
+        # the database change counter that validates the persistent cache is
+        # not bumped by changes to functions alone (eg, their bounds), so the
+        # cache must be saved again to pick up the updated functions
+        #
+
+        if delta and self._cache_key:
+            self._save_cache()
+
+        return delta
+
+    @property
+    def refreshing(self):
+        """
+        Return a bool indicating if a metadata refresh is running.
+        """
+        worker = self._refresh_worker
+        return bool(worker and worker.is_alive())
+
     def abort_refresh(self):
         """
         Abort a running refresh.
@@ -287,89 +664,304 @@ class DatabaseMetadata(object):
         # signal the worker thread to stop
         self._stop_threads = True
 
-    def _async_refresh(self, result_queue, function_addresses, progress_callback):
+    def _async_refresh(self, collector, result_queues, removed_functions, cached_functions, progress_callback, delta_callback):
         """
         Internal asynchronous metadata collection worker.
         """
+        completed = False
 
-        # collect metadata
-        completed = self._async_collect_metadata(function_addresses, progress_callback)
+        #
+        # whatever happens to the refresh, everyone waiting on it must be
+        # released, and the refresh must be cleaned up. otherwise, every
+        # refresh requested after it would be merged into a dead one
+        #
 
-        # refresh the lookup lists
-        self._refresh_lookup()
+        try:
+            completed = self._refresh_metadata(
+                collector,
+                removed_functions,
+                cached_functions,
+                progress_callback,
+                delta_callback
+            )
 
-        # send the refresh result (good/bad) incase anyone is still listening
-        if completed:
-            result_queue.put(self)
-        else:
-            result_queue.put(None)
+        except Exception:
+            logger.exception("Failed to refresh the database metadata")
 
-        # clean up our thread's reference as it is basically done/dead
-        self._refresh_worker = None
+        finally:
+
+            # release anyone still waiting on prioritized functions
+            for waiter in collector.close(force=True):
+                waiter.put(self if completed else None)
+
+            #
+            # clean up our thread's reference as it is basically done/dead.
+            # this is done under the refresh lock, so that no new refresh can
+            # be merged into this one once its futures have been collected
+            #
+
+            with self._refresh_lock:
+                if self._collector is collector:
+                    self._collector = None
+                if self._refresh_worker is threading.current_thread():
+                    self._refresh_worker = None
+                pending_queues = result_queues[:]
+                del result_queues[:]
+
+            # send the refresh result (good/bad) incase anyone is still listening
+            for result_queue in pending_queues:
+                result_queue.put(self if completed else None)
 
         # thread exit...
         return
 
+    def _refresh_metadata(self, collector, removed_functions, cached_functions, progress_callback, delta_callback):
+        """
+        Refresh the database metadata with the given collector.
+
+        Returns True if the refresh completed, or False if it was aborted.
+        """
+
+        # drop the removed functions, and install any valid cached metadata
+        with self.lock:
+            self._remove_functions(removed_functions)
+            self._update_functions(cached_functions)
+
+        #
+        # collect metadata. functions can be merged into the collector by
+        # another refresh request until it is closed, so we keep collecting
+        # until it can be closed with nothing left to collect
+        #
+
+        while True:
+            completed = self._async_collect_metadata(
+                collector,
+                progress_callback,
+                delta_callback
+            )
+
+            waiters = collector.close(force=not completed)
+            if waiters is not None:
+                break
+
+        # refresh the lookup lists
+        with self.lock:
+            self._refresh_lookup()
+
+        #
+        # release anyone still waiting on prioritized functions. after this
+        # point the collector will not accept any more priority requests
+        #
+
+        for waiter in waiters:
+            waiter.put(self if completed else None)
+
+        # persist the collected metadata for the next time the database is opened
+        if completed and self._cache_key and self._cache_stale:
+            self._save_cache()
+            self._cache_stale = False
+
+        return completed
+
+    def _refresh_instructions(self):
+        """
+        Refresh the instruction arrays, returning (addresses, sizes).
+
+        This will only refresh the arrays if they are believed to be stale.
+        """
+
+        #
+        # rather than maintaining a database-wide map of every instruction,
+        # the instructions are kept with the nodes that own them. when they
+        # change, the (sorted) instruction arrays are rebuilt by walking the
+        # nodes in address order. the flag is reset before we rebuild, so
+        # that metadata collected while we build marks them stale again
+        #
+
+        #
+        # the arrays are only rebuilt under the metadata lock. a thread that
+        # can not take it right away (eg, the main thread, while coverage is
+        # being mapped) keeps using the last arrays rather than waiting
+        #
+
+        if self._stale_instructions and self.lock.acquire(False):
+            try:
+                self._stale_instructions = False
+
+                addresses = address_array()
+                sizes = instruction_size_array()
+
+                for node_address, node_metadata in sorted(self.nodes.items()):
+                    addresses.extend(node_metadata.instruction_addresses)
+                    sizes.extend(node_metadata.instruction_sizes)
+
+                # replace both arrays at once, so they are never seen out of sync
+                self._instructions = (addresses, sizes)
+
+            finally:
+                self.lock.release()
+
+        return self._instructions
+
+    def _refresh_instruction_breaks(self, addresses, sizes):
+        """
+        Refresh the adjacency breaks of the given instruction arrays.
+
+        An instruction is adjacent to the one before it if it starts exactly
+        where the previous instruction ends. The returned array holds the
+        (sorted) ordinals of every instruction that is not.
+        """
+
+        # the breaks are still good for these instruction arrays
+        if self._instruction_breaks[0] is addresses:
+            return self._instruction_breaks[1]
+
+        # compare each instruction address to the end of the one before it
+        ends = itertools.imap(operator.add, addresses, sizes)
+        breaks = itertools.imap(operator.ne, itertools.islice(addresses, 1, None), ends)
+        run_breaks = array.array("l", itertools.compress(itertools.count(1), breaks))
+
+        self._instruction_breaks = (addresses, run_breaks)
+        return run_breaks
+
     def _refresh_lookup(self):
         """
-        Refresh the fast lookup address lists.
+        Refresh the fast lookup address lists, returning the lookup index.
 
         This will only refresh the lists if they are believed to be stale.
         """
 
         #
-        # fast lookup lists are simply sorted address lists of functions, nodes
-        # or possibly other (future) metadata.
+        # fast lookup lists are flat interval indexes of nodes and functions,
+        # stored as parallel (start, end, owner) arrays sorted by address.
         #
-        # we create sorted lists of just these metadata addresses so that we
-        # can use them for fast, fuzzy address lookup (eg, bisect) later on.
+        # we create these arrays so that we can use them for fast, fuzzy
+        # address lookup (eg, bisect) later on, either one address at a time
+        # or in bulk (eg, by merging a sorted array of addresses against them)
         #
         #  c.f:
         #   - get_node(ea)
         #   - get_function(ea)
+        #   - resolve_addresses(addresses)
         #
 
         # if the lookup lists are fresh, there's nothing to do
         if not self._stale_lookup:
-            return False
+            return self._lookup
 
-        # update the lookup lists
-        self._node_addresses     = sorted(self.nodes.keys())
-        self._function_addresses = sorted(self.functions.keys())
+        #
+        # the lists are only rebuilt under the metadata lock. a thread that
+        # can not take it right away (eg, the main thread, while coverage is
+        # being mapped) keeps using the last lists rather than waiting
+        #
 
-        # lookup lists are no longer stale, reset the stale flag as such
-        self._stale_lookup = False
+        if not self.lock.acquire(False):
+            return self._lookup
 
-        # refresh success
-        return True
+        try:
+            self._stale_lookup = False
+            lookup = _LookupIndex()
+
+            #
+            # build the node index, and coalesce the contiguous nodes of each
+            # function into function 'chunks'. a function with tails (or gaps
+            # between its nodes) will span multiple chunks in the function index
+            #
+
+            lookup.node_addresses = address_array(sorted(self.nodes.keys()))
+            for node_address in lookup.node_addresses:
+                node_metadata = self.nodes[node_address]
+                node_end = node_address + node_metadata.size
+                function_address = node_metadata.function.address
+
+                lookup.node_ends.append(node_end)
+                lookup.node_owners.append(function_address)
+
+                # extend the current function chunk
+                if lookup.chunk_owners and lookup.chunk_owners[-1] == function_address \
+                   and lookup.chunk_ends[-1] == node_address:
+                    lookup.chunk_ends[-1] = node_end
+                    continue
+
+                # start a new function chunk
+                lookup.chunk_addresses.append(node_address)
+                lookup.chunk_ends.append(node_end)
+                lookup.chunk_owners.append(function_address)
+
+            lookup.function_addresses = address_array(sorted(self.functions.keys()))
+
+            #
+            # the lists are published in a single assignment, so that readers
+            # never see lists from different generations of the metadata
+            #
+
+            self._lookup = lookup
+
+        finally:
+            self.lock.release()
+
+        return self._lookup
 
     #--------------------------------------------------------------------------
     # Metadata Collection
     #--------------------------------------------------------------------------
 
-    def _async_collect_metadata(self, function_addresses, progress_callback):
+    def _async_collect_metadata(self, collector, progress_callback, delta_callback):
         """
         Asynchronously collect metadata from the underlying database.
         """
-        CHUNK_SIZE = 150
-        completed = 0
+        total = collector.total
+
+        #
+        # rather than collecting a fixed number of functions per trip to the
+        # main thread, each trip (slice) is bounded by time. the collector
+        # stops once the slice budget is spent, even if that means pausing
+        # part way through the flowchart of a giant function.
+        #
+        # this keeps IDA responsive on databases with a handful of huge
+        # functions, while still collecting thousands of tiny functions per
+        # slice on databases that are full of them.
+        #
 
-        # loop through every defined function (address) in the database
-        for addresses_chunk in chunks(function_addresses, CHUNK_SIZE):
+        while not collector.finished:
 
             # synchronize and read (collect) function metadata from the
-            # database in controlled chunks (faster in chunks than one by one)
-            fresh_metadata = collect_function_metadata(addresses_chunk)
+            # database for (at most) one slice of main thread time
+            fresh_metadata = collector.collect(SLICE_TIME)
 
-            # update the database metadata with the collected metadata
-            delta = self._update_functions(fresh_metadata)
+            with self.lock:
 
-            # TODO: delta callback
+                # snapshot the metadata of any functions about to be replaced
+                if delta_callback:
+                    old_metadata = {}
+                    for function_address in fresh_metadata:
+                        function_metadata = self.functions.get(function_address, None)
+                        if function_metadata:
+                            old_metadata[function_address] = function_metadata
+
+                # update the database metadata with the collected metadata
+                delta = self._update_functions(fresh_metadata)
+
+                # drop the metadata of functions that no longer exist
+                self._remove_functions(collector.pop_missing())
+
+            # notify anyone waiting on prioritized functions that they are ready
+            for waiter in collector.pop_waiters():
+                waiter.put(self)
+
+            #
+            # stream the delta of the metadata we just collected to the
+            # subscriber, so that it can act on these functions (eg, map
+            # coverage to them) while the rest are still being collected
+            #
+
+            if delta_callback and delta:
+                old_metadata = dict((ea, old_metadata[ea]) for ea in delta if ea in old_metadata)
+                delta_callback(MetadataDelta.from_functions(delta, old_metadata))
 
             # report progress to an external subscriber
             if progress_callback:
-                completed += len(addresses_chunk)
-                progress_callback(completed, len(function_addresses))
+                progress_callback(collector.completed, total)
 
             # if an abort was requested, bail immediately
             if self._stop_threads:
@@ -377,49 +969,160 @@ class DatabaseMetadata(object):
                 return False
 
             # sleep some so we don't choke the main IDA thread
-            time.sleep(.0015)
+            time.sleep(YIELD_TIME)
+
+        logger.debug(
+            "Collected metadata for %u functions (%u nodes) in %.2fs, %.0f functions/s" % \
+            (collector.completed, collector.node_count, collector.elapsed, collector.throughput)
+        )
 
         # completed normally
         return True
 
-    def _update_functions(self, fresh_metadata):
+    def _load_cache(self, function_addresses):
         """
-        Update stored function metadata with the given fresh metadata.
+        Load function metadata from the persistent metadata cache.
 
-        Returns a map of function metadata that has been updated.
+        Returns a tuple of (cached_functions, function_addresses) where
+        cached_functions maps the addresses of the valid cached functions to
+        their metadata, and function_addresses lists the given functions that
+        still need to be collected (they were not cached, or are stale).
         """
-        delta = {}
+        cache_path = self._cache_path
+        input_md5, change_count = self._cache_key
+
+        # load the metadata cache for this database (if there is one)
+        cache = load_metadata_cache(cache_path, input_md5)
+        if not cache:
+            return ({}, function_addresses)
+        cached_change_count, cached_functions = cache
 
         #
-        # the first step is to loop through the 'fresh' function metadata that
-        # has been given to us, and identify what is truly new or different
-        # from any existing metadata we hold.
+        # if the database has not changed at all since the metadata cache was
+        # written, the bytes of every cached function are still the same. but
+        # the change counter is not bumped by changes to the functions alone,
+        # so the bounds of each cached function are still checked (cheaply).
+        #
+        # otherwise, each cached function is validated against a signature of
+        # it (its bounds, chunks, name, and bytes) as it exists in the database
         #
 
-        for function_address, new_metadata in fresh_metadata.iteritems():
+        unchanged = change_count is not None and change_count == cached_change_count
 
-            # extract the 'old' metadata from the database metadata
-            old_metadata = self.functions.get(function_address, None)
+        valid_functions = {}
+        for function_address in function_addresses:
+            function_metadata = cached_functions.get(function_address, None)
+            if not (function_metadata and function_metadata.signature):
+                continue
+            if unchanged:
+                valid = function_metadata.signature[:2] == get_function_bounds(function_address)
+            else:
+                valid = function_metadata.signature == get_function_signature(function_address)
+            if valid:
+                valid_functions[function_address] = function_metadata
+
+        logger.debug(
+            "Loaded %u/%u functions from the metadata cache" % \
+            (len(valid_functions), len(function_addresses))
+        )
 
-            #
-            # if the fresh metadata for this function is identical to the
-            # existing metadata we have collected for it, there's nothing
-            # else for us to do - just ignore it.
-            #
+        # there is no need to re-save the cache if it was entirely up to date
+        if unchanged and len(valid_functions) == len(function_addresses):
+            self._cache_stale = False
 
-            if old_metadata and old_metadata == new_metadata:
-                continue
+        # return the valid cached metadata, and the functions that will need to be (re)collected
+        return (valid_functions, [ea for ea in function_addresses if ea not in valid_functions])
 
-            #
-            # this function is either new, or was updated since the last time
-            # its metadata was refreshed. save the function metadata to the
-            # delta map so we can notify listeners that it has been modified.
-            #
+    def _save_cache(self):
+        """
+        Save the function metadata to the persistent metadata cache.
+        """
+        cache_path = self._cache_path
+        input_md5, change_count = self._cache_key
 
-            delta[function_address] = new_metadata
+        # snapshot the functions, so they are not changed while being saved
+        with self.lock:
+            functions = dict(self.functions)
 
-        #
-        # save the current node & function count before we merge in the delta
+        # the cache can be saved by both the refresh and update workers
+        try:
+            with self._cache_save_lock:
+                save_metadata_cache(cache_path, input_md5, change_count, functions)
+        except (IOError, OSError) as e:
+            logger.error("Failed to save metadata cache %s" % cache_path)
+            logger.error(e)
+
+    def _remove_functions(self, function_addresses):
+        """
+        Remove the metadata of the given functions.
+        """
+        removed = False
+
+        for function_address in function_addresses:
+            function_metadata = self.functions.pop(function_address, None)
+            if not function_metadata:
+                continue
+            self._remove_nodes(function_metadata)
+            removed = True
+
+        # schedule a deferred lookup list refresh if we deleted any functions
+        if removed:
+            self._stale_lookup = True
+            self._stale_instructions = True
+
+    def _remove_nodes(self, function_metadata):
+        """
+        Remove the node (and instruction) metadata owned by the given function.
+        """
+        for node_address, node_metadata in function_metadata.nodes.iteritems():
+
+            # the node may have already been claimed by a newer function
+            if self.nodes.get(node_address, None) is not node_metadata:
+                continue
+
+            del self.nodes[node_address]
+
+        # the instruction arrays will need to be rebuilt (on demand)
+        self._stale_instructions = True
+
+    def _update_functions(self, fresh_metadata):
+        """
+        Update stored function metadata with the given fresh metadata.
+
+        Returns a map of function metadata that has been updated.
+        """
+        delta = {}
+
+        #
+        # the first step is to loop through the 'fresh' function metadata that
+        # has been given to us, and identify what is truly new or different
+        # from any existing metadata we hold.
+        #
+
+        for function_address, new_metadata in fresh_metadata.iteritems():
+
+            # extract the 'old' metadata from the database metadata
+            old_metadata = self.functions.get(function_address, None)
+
+            #
+            # if the fresh metadata for this function is identical to the
+            # existing metadata we have collected for it, there's nothing
+            # else for us to do - just ignore it.
+            #
+
+            if old_metadata and old_metadata == new_metadata:
+                continue
+
+            #
+            # this function is either new, or was updated since the last time
+            # its metadata was refreshed. save the function metadata to the
+            # delta map so we can notify listeners that it has been modified.
+            #
+
+            delta[function_address] = new_metadata
+
+        #
+        # save the current node & function count before we merge in the delta
         # updates. this will enable us to very quickly tell if anything has
         # been added (versus updated)
         #
@@ -427,6 +1130,18 @@ class DatabaseMetadata(object):
         node_count     = len(self.nodes)
         function_count = len(self.functions)
 
+        #
+        # the nodes of functions that are being replaced may no longer exist
+        # in their latest metadata, so we drop them before merging the delta
+        #
+
+        replaced = False
+        for function_address in delta:
+            old_metadata = self.functions.get(function_address, None)
+            if old_metadata:
+                self._remove_nodes(old_metadata)
+                replaced = True
+
         #
         # now we can update the database-wide metadata maps with only the new
         # data that we know to have changed (the delta)
@@ -435,24 +1150,168 @@ class DatabaseMetadata(object):
         # update the functions metadata map
         self.functions.update(delta)
 
-        # update the node & instruction metadata maps
+        # update the node metadata map
         for function_metadata in delta.itervalues():
             self.nodes.update(function_metadata.nodes)
-            for node_metadata in function_metadata.nodes.itervalues():
-                self.instructions.update(node_metadata.instructions)
+
+        # the instruction arrays will need to be rebuilt (on demand)
+        if delta:
+            self._stale_instructions = True
 
         #
         # if the function or node count has changed, we will know that
         # something must have been added, therefore our lookup lists will
-        # need to be rebuilt/sorted. schedule a deferred refresh
+        # need to be rebuilt/sorted. schedule a deferred refresh.
+        #
+        # replaced functions may have moved their nodes around without
+        # changing the node count, so they also warrant a refresh
         #
 
         if (node_count != len(self.nodes)) or (function_count != len(self.functions)):
             self._stale_lookup = True
+        elif replaced:
+            self._stale_lookup = True
 
         # return the delta for other interested consumers to use
         return delta
 
+#------------------------------------------------------------------------------
+# Interval Index Helpers
+#------------------------------------------------------------------------------
+
+class _LookupIndex(object):
+    """
+    The interval indexes of the database nodes and functions.
+    """
+
+    __slots__ = (
+        "node_addresses",
+        "node_ends",
+        "node_owners",
+        "chunk_addresses",
+        "chunk_ends",
+        "chunk_owners",
+        "function_addresses",
+    )
+
+    def __init__(self):
+        self.node_addresses = address_array()
+        self.node_ends = address_array()
+        self.node_owners = address_array()
+        self.chunk_addresses = address_array()
+        self.chunk_ends = address_array()
+        self.chunk_owners = address_array()
+        self.function_addresses = address_array()
+
+def _find_interval(starts, ends, address):
+    """
+    Find the index of the interval containing the given address (or -1).
+    """
+    index = bisect.bisect_right(starts, address) - 1
+    if index >= 0 and address < ends[index]:
+        return index
+    return -1
+
+def _iter_interval_runs(starts, ends, addresses):
+    """
+    Walk a sorted array of addresses against a sorted interval index.
+
+    Yields (interval_index, start, end) tuples for each run of addresses in
+    addresses[start:end] that fall within the same interval, or -1 for runs
+    of addresses that do not fall within any interval.
+    """
+
+    #
+    # the addresses and the intervals are walked together in a single merge
+    # pass. both cursors only ever move forward, but rather than stepping
+    # them one entry at a time, each cursor 'gallops' ahead by bisecting only
+    # the entries past its current position. this keeps the walk linear in
+    # the worst case, but lets it skip over long runs of addresses (or
+    # intervals) in one step
+    #
+
+    index, count = 0, len(addresses)
+    interval, interval_count = 0, len(starts)
+
+    while index < count:
+        address = addresses[index]
+
+        # advance the interval cursor past every interval starting at/before this address
+        interval = bisect.bisect_right(starts, address, interval)
+
+        # the run of addresses up to the start of the next interval
+        if interval < interval_count:
+            next_index = bisect.bisect_left(addresses, starts[interval], index)
+        else:
+            next_index = count
+
+        # there is no interval before this address, so nothing in this run falls in one
+        if not interval:
+            yield (-1, index, next_index)
+            index = next_index
+            continue
+
+        #
+        # the addresses of the run before the end of the prior interval fall
+        # within it, while the rest fall in the gap before the next interval
+        #
+
+        end_index = bisect.bisect_left(addresses, ends[interval-1], index, next_index)
+        if end_index > index:
+            yield (interval-1, index, end_index)
+        if next_index > end_index:
+            yield (-1, end_index, next_index)
+
+        index = next_index
+
+def _walk_block(instruction_addresses, instruction_sizes, address, end_address, index, output):
+    """
+    Flatten a single block one instruction (or byte) at a time.
+
+    The given index is that of the first known instruction at (or after)
+    the start of the block. Flattened addresses are appended to output.
+    """
+    instruction_count = len(instruction_addresses)
+
+    # loop through the byte range defined by the basic block
+    while address < end_address:
+
+        # save the current address as an instruction address
+        output.append(address)
+
+        # skip any known instructions that we have moved beyond
+        while index < instruction_count and instruction_addresses[index] < address:
+            index += 1
+
+        # move forward to the next instruction (or byte) address
+        if index < instruction_count and instruction_addresses[index] == address:
+            address += instruction_sizes[index]
+            index += 1
+        else:
+            address += 1
+
+#------------------------------------------------------------------------------
+# Compact Metadata Helpers
+#------------------------------------------------------------------------------
+
+# the array typecode (and item size) used to store instruction sizes
+INSTRUCTION_SIZE_TYPECODE = "I"
+INSTRUCTION_SIZE_BYTES = array.array(INSTRUCTION_SIZE_TYPECODE).itemsize
+
+def instruction_size_array(sizes=""):
+    """
+    Create an array of instruction sizes (from an iterable or packed string).
+    """
+    return array.array(INSTRUCTION_SIZE_TYPECODE, sizes)
+
+def intern_name(name):
+    """
+    Intern a function name, so that names shared by many objects are stored once.
+    """
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
 #------------------------------------------------------------------------------
 # Function Level Metadata
 #------------------------------------------------------------------------------
@@ -462,7 +1321,26 @@ class FunctionMetadata(object):
     Fast access function level metadata cache.
     """
 
-    def __init__(self, address):
+    #
+    # NOTE/PERF:
+    #
+    #   a database can hold many thousands of functions and nodes. defining
+    #   __slots__ means these objects do not each carry a __dict__, which
+    #   makes up the bulk of their memory footprint
+    #
+
+    __slots__ = (
+        "address",
+        "name",
+        "nodes",
+        "size",
+        "node_count",
+        "instruction_count",
+        "signature",
+        "fingerprint",
+    )
+
+    def __init__(self, address, build=True):
 
         # function metadata
         self.address = address
@@ -476,8 +1354,31 @@ class FunctionMetadata(object):
         self.node_count = 0
         self.instruction_count = 0
 
+        # a cheap signature of the function, to validate cached metadata
+        self.signature = None
+
+        # a structural fingerprint of the function nodes (see _finalize)
+        self.fingerprint = None
+
         # collect metdata from the underlying database
-        self._build_metadata()
+        if build:
+            self._build_metadata()
+
+    @classmethod
+    def from_cache(cls, address, name, signature):
+        """
+        Create function metadata from the metadata cache (no nodes).
+        """
+        function_metadata = cls.__new__(cls)
+        function_metadata.address = address
+        function_metadata.name = intern_name(name)
+        function_metadata.nodes = {}
+        function_metadata.size = 0
+        function_metadata.node_count = 0
+        function_metadata.instruction_count = 0
+        function_metadata.signature = signature
+        function_metadata.fingerprint = None
+        return function_metadata
 
     #--------------------------------------------------------------------------
     # Properties
@@ -488,7 +1389,9 @@ class FunctionMetadata(object):
         """
         The instruction addresses in this function.
         """
-        return set([ea for node in self.nodes.itervalues() for ea in node.instructions.keys()])
+        return set(itertools.chain.from_iterable(
+            node.instruction_addresses for node in self.nodes.itervalues()
+        ))
 
     #--------------------------------------------------------------------------
     # Metadata Population
@@ -501,25 +1404,41 @@ class FunctionMetadata(object):
         self._refresh_name()
         self._refresh_nodes()
         self._finalize()
+        self.signature = get_function_signature(self.address)
 
     def _refresh_name(self):
         """
         Refresh the function name against the open database.
         """
-        self.name = idaapi.get_func_name2(self.address)
+        self.name = intern_name(idaapi.get_func_name2(self.address))
 
     def _refresh_nodes(self):
         """
         Refresh the function nodes against the open database.
         """
-        function_metadata = self
+        flowchart = self._get_flowchart()
+        self._collect_nodes(flowchart, 0)
 
-        # dispose of stale information
-        function_metadata.nodes = {}
+    def _get_flowchart(self):
+        """
+        Dispose of stale node information, and get the function flowchart.
+        """
+        self.nodes = {}
 
         # get function & flowchart object from database
-        function  = idaapi.get_func(self.address)
-        flowchart = idaapi.qflow_chart_t("", function, idaapi.BADADDR, idaapi.BADADDR, 0)
+        function = idaapi.get_func(self.address)
+        return idaapi.qflow_chart_t("", function, idaapi.BADADDR, idaapi.BADADDR, 0)
+
+    def _collect_nodes(self, flowchart, node_id, deadline=None):
+        """
+        Collect the function nodes from its flowchart, starting at node_id.
+
+        If a deadline is given, collection is paused once it has passed.
+        Returns the id of the next node to collect, which is the flowchart
+        size once all of the nodes have been collected.
+        """
+        function_metadata = self
+        node_count = flowchart.size()
 
         #
         # now we will walk the flowchart for this function, collecting
@@ -527,8 +1446,14 @@ class FunctionMetadata(object):
         # the function & node metadata objects.
         #
 
-        for node_id in xrange(flowchart.size()):
+        while node_id < node_count:
+
+            # out of time, pause collection at this node
+            if deadline and time.time() >= deadline:
+                break
+
             node = flowchart[node_id]
+            node_id += 1
 
             # TODO
             if node.startEA == node.endEA:
@@ -542,7 +1467,7 @@ class FunctionMetadata(object):
             # that we do not have to walk the flowchart to locate it every time
             #
 
-            node_metadata.id = node_id
+            node_metadata.id = node_id - 1
 
             #
             # establish a relationship between this node (basic block) and
@@ -552,6 +1477,8 @@ class FunctionMetadata(object):
             node_metadata.function = function_metadata
             function_metadata.nodes[node.startEA] = node_metadata
 
+        return node_id
+
     def _finalize(self):
         """
         Finalize function metadata for use.
@@ -560,6 +1487,42 @@ class FunctionMetadata(object):
         self.node_count = len(self.nodes)
         self.instruction_count = sum(node.instruction_count for node in self.nodes.itervalues())
 
+        #
+        # the fingerprint summarizes the structure of the function: the
+        # layout of its nodes, and the instructions (and their sizes) within
+        # them. two versions of a function with different fingerprints are
+        # known to differ, without comparing their nodes (see same_structure)
+        #
+
+        self.fingerprint = hash(tuple(sorted(
+            (node.address, node.size, node._instruction_sizes)
+            for node in self.nodes.itervalues()
+        )))
+
+    def same_structure(self, other):
+        """
+        Return True if two versions of a function have identical nodes.
+        """
+        if self.fingerprint != other.fingerprint:
+            return False
+
+        #
+        # the fingerprint is a native hash, which is only 32 bits on some
+        # platforms (eg, Windows). matching fingerprints could be a collision,
+        # so the nodes are compared to confirm that they truly match
+        #
+
+        if self.nodes.viewkeys() != other.nodes.viewkeys():
+            return False
+
+        for node_address, node_metadata in self.nodes.iteritems():
+            other_node = other.nodes[node_address]
+            if node_metadata.size != other_node.size \
+               or node_metadata._instruction_sizes != other_node._instruction_sizes:
+                return False
+
+        return True
+
     #--------------------------------------------------------------------------
     # Signal Handlers
     #--------------------------------------------------------------------------
@@ -567,10 +1530,8 @@ class FunctionMetadata(object):
     def name_changed(self, new_name):
         """
         Handler for rename event in IDA.
-
-        TODO: hook this up
         """
-        self.name = new_name
+        self.name = intern_name(new_name)
 
     #--------------------------------------------------------------------------
     # Operator Overloads
@@ -586,8 +1547,7 @@ class FunctionMetadata(object):
         result &= self.address == other.address
         result &= self.node_count == other.node_count
         result &= self.instruction_count == other.instruction_count
-        result &= self.nodes.viewkeys() == other.nodes.viewkeys()
-        return result
+        return result and self.same_structure(other)
 
 #------------------------------------------------------------------------------
 # Node Level Metadata
@@ -598,6 +1558,15 @@ class NodeMetadata(object):
     Fast access node level metadata cache.
     """
 
+    __slots__ = (
+        "address",
+        "size",
+        "id",
+        "function",
+        "instruction_count",
+        "_instruction_sizes",
+    )
+
     def __init__(self, node):
 
         # node metadata
@@ -611,14 +1580,64 @@ class NodeMetadata(object):
         # parent function_metadata
         self.function = None
 
-        # maps instruction_address --> instruction_metadata
-        self.instructions = {}
+        #
+        # the sizes of the instructions in this node, in address order. as
+        # the instructions of a node are contiguous, their addresses can be
+        # derived from these. they are packed into an immutable string, the
+        # most compact (and cheaply hashed) representation available to us
+        #
+
+        self._instruction_sizes = ""
 
         #----------------------------------------------------------------------
 
         # collect metdata from the underlying database
         self._build_metadata()
 
+    @classmethod
+    def from_cache(cls, address, size, node_id, instruction_sizes):
+        """
+        Create node metadata from the metadata cache.
+        """
+        node_metadata = cls.__new__(cls)
+        node_metadata.size = size
+        node_metadata.address = address
+        node_metadata.id = node_id
+        node_metadata.function = None
+        node_metadata._instruction_sizes = instruction_sizes
+        node_metadata.instruction_count = len(instruction_sizes) / INSTRUCTION_SIZE_BYTES
+        return node_metadata
+
+    #--------------------------------------------------------------------------
+    # Properties
+    #--------------------------------------------------------------------------
+
+    @property
+    def instruction_sizes(self):
+        """
+        The sizes of the instructions in this node, in address order.
+        """
+        return instruction_size_array(self._instruction_sizes)
+
+    @property
+    def instruction_addresses(self):
+        """
+        The addresses of the instructions in this node, in address order.
+        """
+        addresses = []
+        address = self.address
+        for size in self.instruction_sizes:
+            addresses.append(address)
+            address += size
+        return addresses
+
+    @property
+    def instructions(self):
+        """
+        A map of instruction address --> instruction size (built on access).
+        """
+        return dict(itertools.izip(self.instruction_addresses, self.instruction_sizes))
+
     #--------------------------------------------------------------------------
     # Metadata Population
     #--------------------------------------------------------------------------
@@ -629,6 +1648,7 @@ class NodeMetadata(object):
         """
         current_address = self.address
         node_end = self.address + self.size
+        instruction_sizes = instruction_size_array()
 
         #
         # loop through the node's entire range and count its instructions
@@ -637,11 +1657,12 @@ class NodeMetadata(object):
 
         while current_address < node_end:
             instruction_size = idaapi.get_item_end(current_address) - current_address
-            self.instructions[current_address] = instruction_size
+            instruction_sizes.append(instruction_size)
             current_address += instruction_size
 
-        # save the number of instructions in this block
-        self.instruction_count = len(self.instructions)
+        # save the instructions, and the number of instructions in this block
+        self._instruction_sizes = instruction_sizes.tostring()
+        self.instruction_count = len(instruction_sizes)
 
     #--------------------------------------------------------------------------
     # Operator Overloads
@@ -679,8 +1700,9 @@ class NodeMetadata(object):
         result &= self.size == other.size
         result &= self.address == other.address
         result &= self.instruction_count == other.instruction_count
-        result &= self.function == other.function
+        result &= self.function.address == other.function.address
         result &= self.id == other.id
+        result &= self._instruction_sizes == other._instruction_sizes
         return result
 
 #------------------------------------------------------------------------------
@@ -707,7 +1729,7 @@ class MetadataDelta(object):
     The computed delta between two DatabaseMetadata objects.
     """
 
-    def __init__(self, new_metadata, old_metadata):
+    def __init__(self, new_metadata=None, old_metadata=None):
 
         # nodes
         self.nodes_added    = set()
@@ -718,10 +1740,31 @@ class MetadataDelta(object):
         self.functions_added    = set()
         self.functions_removed  = set()
         self.functions_modified = set()
-        self._dirty_functions   = set() # internal use only
 
         # compute the difference between the two metadata objects
-        self._compute_delta(new_metadata, old_metadata)
+        if new_metadata is not None:
+            self._compute_delta(new_metadata, old_metadata)
+
+    @classmethod
+    def from_functions(cls, new_functions, old_functions):
+        """
+        Compute the delta between two maps of function metadata.
+
+        This is used to compute the delta of a partial metadata update,
+        without having to diff the entire database metadata.
+        """
+        delta = cls()
+        delta._compute_function_delta(new_functions, old_functions)
+        return delta
+
+    def __nonzero__(self):
+        """
+        Return a bool indicating if the delta holds any changes.
+        """
+        return bool(
+            self.nodes_added or self.nodes_removed or self.nodes_modified or \
+            self.functions_added or self.functions_removed or self.functions_modified
+        )
 
     def _compute_delta(self, new_metadata, old_metadata):
         """
@@ -751,21 +1794,65 @@ class MetadataDelta(object):
         # that we need to diff against each other, so compute their delta now
         #
 
-        # compute the node delta
-        self._compute_node_delta(new_metadata.nodes, old_metadata.nodes)
-
-        # compute the function delta
         self._compute_function_delta(new_metadata.functions, old_metadata.functions)
 
-        # done
-        return
+    def _compute_function_delta(self, new_functions, old_functions):
+        """
+        Compute the delta between two dictionaries of function metadata.
+        """
+        new_nodes, old_nodes = {}, {}
+
+        #
+        # rather than diffing every node in the database, we compare the
+        # structure of the functions on either side of the delta. only the
+        # nodes of functions that were added, removed, or whose structure
+        # has changed need to be diffed node by node.
+        #
+        # this means the cost of a delta is proportional to the functions
+        # that actually changed, not the size of the database.
+        #
+
+        for function_address in new_functions.viewkeys() | old_functions.viewkeys():
+
+            # probe for this function in the metadata sets
+            new_func_metadata = new_functions.get(function_address, None)
+            old_func_metadata = old_functions.get(function_address, None)
+
+            # the function does NOT exist in the new metadata, so it was deleted
+            if not new_func_metadata:
+                self.functions_removed.add(function_address)
+                old_nodes.update(old_func_metadata.nodes)
+                continue
+
+            # the function does NOT exist in the old metadata, so it was added
+            if not old_func_metadata:
+                self.functions_added.add(function_address)
+                new_nodes.update(new_func_metadata.nodes)
+                continue
+
+            #
+            # ~ the function exists in *both* metadata sets ~
+            #
+
+            # if the function structure is identical, there's no delta (change)
+            if new_func_metadata is old_func_metadata or \
+               new_func_metadata.same_structure(old_func_metadata):
+                continue
+
+            # the function structure does not match, diff its nodes
+            self.functions_modified.add(function_address)
+            new_nodes.update(new_func_metadata.nodes)
+            old_nodes.update(old_func_metadata.nodes)
+
+        # compute the delta of just the nodes in the changed functions
+        self._compute_node_delta(new_nodes, old_nodes)
 
     def _compute_node_delta(self, new_nodes, old_nodes):
         """
         Compute the delta between two dictionaries of node metadata.
         """
 
-        # loop through *all* the node addresses in both metadata objects
+        # loop through *all* the node addresses in both node maps
         all_node_addresses = new_nodes.viewkeys() | old_nodes.viewkeys()
         for node_address in all_node_addresses:
 
@@ -776,13 +1863,11 @@ class MetadataDelta(object):
             # the node does NOT exist in the new metadata, so it was deleted
             if not new_node_metadata:
                 self.nodes_removed.add(node_address)
-                self._dirty_functions |= set(old_node_metadata.functions.viewkeys())
                 continue
 
             # the node does NOT exist in the old metadata, so it was added
             if not old_node_metadata:
                 self.nodes_added.add(node_address)
-                self._dirty_functions |= set(new_node_metadata.functions.viewkeys())
                 continue
 
             #
@@ -795,51 +1880,6 @@ class MetadataDelta(object):
 
             # the nodes do not match, that's a difference!
             self.nodes_modified.add(node_address)
-            self._dirty_functions |= set(new_node_metadata.functions.viewkeys())
-            self._dirty_functions |= set(old_node_metadata.functions.viewkeys())
-
-    def _compute_function_delta(self, new_functions, old_functions):
-        """
-        Compute the delta between two dictionaries of function metadata.
-        """
-
-        #
-        # thanks to the work we did in _compute_node_delta, in theory we know
-        # exactly which functions may have changed between the two metadata sets
-        #
-        # we loop through only these addresses, and bucketize them as needed
-        #
-
-        for function_address in self._dirty_functions:
-
-            # probe for this function in the metadata sets
-            new_func_metadata = new_functions.get(function_address, None)
-            old_func_metadata = old_functions.get(function_address, None)
-
-            # the function does NOT exist in the new metadata, so it was deleted
-            if not new_func_metadata:
-                self.functions_removed.add(function_address)
-                continue
-
-            # the function does NOT exist in the old metadata, so it was added
-            if not old_func_metadata:
-                self.functions_added.add(function_address)
-                continue
-
-            #
-            # ~ the function exists in *both* metadata sets ~
-            #
-
-            #
-            # in theory, every function that makes it this far given the
-            # self._dirty_functions set should be different as one of its
-            # underlying nodes were known to have changed...
-            #
-
-            self.functions_modified.add(function_address)
-
-        # dispose of the dirty functions list as they're no longer needed
-        self._dirty_functions = set()
 
     #--------------------------------------------------------------------------
     # Informational / Debug - TODO: REMOVE
@@ -880,6 +1920,374 @@ class MetadataDelta(object):
         lmsg("Functions modified:")
         lmsg(hex_list(self.functions_modified))
 
+#------------------------------------------------------------------------------
+# Metadata Hooks
+#------------------------------------------------------------------------------
+
+class MetadataHooks(object):
+    """
+    Database event hooks, used to keep the metadata in sync with the database.
+
+    These hooks do no real work of their own. They simply report the
+    addresses of functions that have been defined, undefined, renamed, or
+    modified by the user (or auto-analysis) to the given 'functions_changed'
+    callback, so that their metadata can be re-collected in the background.
+
+    Function renames are also reported to the 'function_renamed' callback.
+    """
+
+    def __init__(self, functions_changed, function_renamed):
+        self._functions_changed = functions_changed
+        self._function_renamed = function_renamed
+
+        #
+        # NOTE/COMPAT:
+        #
+        #   IDA 7 reports all of the events we care about as IDB events. but
+        #   prior to IDA 7, function (un)definition, resizing, renames, and
+        #   item creation are reported as IDP (processor) events instead, so
+        #   we must subscribe to both there
+        #
+
+        self._hooks = [_MetadataIDBHooks(self)]
+        if idaapi.IDA_SDK_VERSION < 700:
+            self._hooks.append(_MetadataIDPHooks(self))
+
+    def hook(self):
+        """
+        Install the database event hooks.
+        """
+        for hooks in self._hooks:
+            hooks.hook()
+
+    def unhook(self):
+        """
+        Remove the database event hooks.
+        """
+        for hooks in self._hooks:
+            hooks.unhook()
+
+    #--------------------------------------------------------------------------
+    # Event Reporting
+    #--------------------------------------------------------------------------
+
+    def functions_changed(self, function_addresses):
+        """
+        Report functions that have been defined, undefined, or modified.
+        """
+        self._functions_changed(function_addresses)
+
+    def renamed(self, ea, new_name):
+        """
+        Report a renamed address, if it is the start of a function.
+        """
+        function = idaapi.get_func(ea)
+        if not (function and function.startEA == ea):
+            return
+        self._function_renamed(ea, new_name)
+        self._functions_changed([ea])
+
+    def item_changed(self, ea):
+        """
+        Report the function containing a changed item (if any).
+        """
+        function = idaapi.get_func(ea)
+        if function:
+            self._functions_changed([function.startEA])
+
+class _MetadataIDBHooks(idaapi.IDB_Hooks):
+    """
+    The IDB events of MetadataHooks.
+    """
+
+    def __init__(self, reporter):
+        super(_MetadataIDBHooks, self).__init__()
+        self._reporter = reporter
+
+    #--------------------------------------------------------------------------
+    # Function Events
+    #--------------------------------------------------------------------------
+
+    def func_added(self, pfn):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def deleting_func(self, pfn):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def func_updated(self, pfn):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def set_func_start(self, pfn, new_start):
+        self._reporter.functions_changed([pfn.startEA, new_start])
+        return 0
+
+    def set_func_end(self, pfn, new_end):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def func_tail_appended(self, pfn, tail):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def func_tail_removed(self, pfn, tail_ea):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def func_tail_deleted(self, pfn, tail_ea):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def renamed(self, ea, new_name, local_name):
+        self._reporter.renamed(ea, new_name)
+        return 0
+
+    #--------------------------------------------------------------------------
+    # Item Events
+    #--------------------------------------------------------------------------
+
+    def make_code(self, insn):
+        self._reporter.item_changed(insn.ea)
+        return 0
+
+    def make_data(self, ea, flags, tid, size):
+        self._reporter.item_changed(ea)
+        return 0
+
+class _MetadataIDPHooks(idaapi.IDP_Hooks):
+    """
+    The IDP events of MetadataHooks (IDA 6.x only).
+    """
+
+    def __init__(self, reporter):
+        super(_MetadataIDPHooks, self).__init__()
+        self._reporter = reporter
+
+    #--------------------------------------------------------------------------
+    # Function Events
+    #--------------------------------------------------------------------------
+
+    def add_func(self, pfn):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def del_func(self, pfn):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def set_func_start(self, pfn, new_start):
+        self._reporter.functions_changed([pfn.startEA, new_start])
+        return 0
+
+    def set_func_end(self, pfn, new_end):
+        self._reporter.functions_changed([pfn.startEA])
+        return 0
+
+    def renamed(self, ea, new_name, local_name):
+        self._reporter.renamed(ea, new_name)
+        return 0
+
+    #--------------------------------------------------------------------------
+    # Item Events
+    #--------------------------------------------------------------------------
+
+    def make_code(self, ea, size):
+        self._reporter.item_changed(ea)
+        return 0
+
+    def make_data(self, ea, flags, tid, size):
+        self._reporter.item_changed(ea)
+        return 0
+
+#------------------------------------------------------------------------------
+# Metadata Cache
+#------------------------------------------------------------------------------
+#
+#    The metadata cache persists the lifted function, node, and instruction
+#    metadata of a database to a compact binary file beside the database.
+#
+#    The cache is keyed to the MD5 of the database's input file, and records
+#    the database change counter as of when it was written. If the counter
+#    is unchanged upon load, only the bounds of each cached function are
+#    checked. Otherwise, each cached function is validated against a cheap
+#    signature of the function as it currently exists in the database, and
+#    only the functions that fail validation are re-collected.
+#
+#    The counter is not bumped by changes to functions alone, so the cache
+#    is saved again whenever the hooks update the metadata of functions.
+#
+#    The cache is stored as parallel (columnar) lists of integers, as these
+#    are very fast to serialize with marshal, and compress well with zlib.
+#
+
+METADATA_CACHE_MAGIC   = "LHMC"
+METADATA_CACHE_VERSION = 3
+
+def get_metadata_cache_path():
+    """
+    Get the path of the metadata cache file for the open database.
+    """
+    return idc.GetIdbPath() + ".lighthouse"
+
+def get_metadata_cache_key():
+    """
+    Get the (input md5, database change count) key of the open database.
+    """
+    return (idc.GetInputMD5(), get_database_change_count())
+
+def get_function_bounds(function_address):
+    """
+    Get the bounds (end address, tail count) of a database function.
+
+    These are the leading fields of its signature (see get_function_signature).
+    """
+    function = idaapi.get_func(function_address)
+    if not function:
+        return None
+    return (function.endEA, function.tailqty)
+
+def get_function_signature(function_address):
+    """
+    Get a cheap signature of a database function, to validate cached metadata.
+    """
+    function = idaapi.get_func(function_address)
+    if not function:
+        return None
+
+    #
+    # the bounds of a function say nothing of what lies within them. a
+    # checksum of the bytes in each of its chunks ensures that a function
+    # patched (or re-assembled) in place does not pass for its old self
+    #
+
+    checksum = 0
+    for start, end in idautils.Chunks(function_address):
+        checksum = zlib.crc32(idaapi.get_many_bytes(start, end - start) or "", checksum)
+
+    return (
+        function.endEA,
+        function.tailqty,
+        function.flags,
+        idaapi.get_func_name2(function_address),
+        checksum
+    )
+
+def save_metadata_cache(filepath, input_md5, change_count, functions):
+    """
+    Save the given function metadata to a metadata cache file.
+    """
+    function_table = ([], [], [], [])
+    node_table = ([], [], [], [])
+
+    #
+    # flatten the function and node metadata into columns. each function is
+    # followed by its nodes, so the tables can be walked back together on
+    # load. the (packed) instruction sizes of each node are kept as-is
+    #
+
+    for function_metadata in functions.itervalues():
+        function_table[0].append(function_metadata.address)
+        function_table[1].append(function_metadata.name)
+        function_table[2].append(function_metadata.signature)
+        function_table[3].append(len(function_metadata.nodes))
+
+        for node_metadata in function_metadata.nodes.itervalues():
+            node_table[0].append(node_metadata.address)
+            node_table[1].append(node_metadata.size)
+            node_table[2].append(node_metadata.id)
+            node_table[3].append(node_metadata._instruction_sizes)
+
+    payload = (
+        METADATA_CACHE_VERSION,
+        input_md5,
+        change_count,
+        function_table,
+        node_table
+    )
+
+    data = METADATA_CACHE_MAGIC + zlib.compress(marshal.dumps(payload), 1)
+
+    # write the cache to a temporary file first, so it can never be left torn
+    temp_path = filepath + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+
+    # NOTE/COMPAT: os.rename() will not replace an existing file on Windows
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    os.rename(temp_path, filepath)
+
+def load_metadata_cache(filepath, input_md5):
+    """
+    Load function metadata from a metadata cache file.
+
+    Returns a (change_count, functions) tuple, or None if there is no
+    usable cache for the given input md5.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    # ensure this is a metadata cache of the format we are expecting
+    if not data.startswith(METADATA_CACHE_MAGIC):
+        return None
+
+    #
+    # NOTE/PERF:
+    #
+    #   loading the cache allocates a large number of (long lived) objects
+    #   in quick succession, which repeatedly triggers python's cyclic
+    #   garbage collector for no gain. pausing it roughly halves load times
+    #
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load_metadata_cache(data, filepath, input_md5)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _load_metadata_cache(data, filepath, input_md5):
+    """
+    Internal decoding of metadata cache file data.
+    """
+    try:
+        payload = marshal.loads(zlib.decompress(data[len(METADATA_CACHE_MAGIC):]))
+    except (zlib.error, ValueError, EOFError, TypeError):
+        logger.debug("Failed to decode metadata cache %s" % filepath)
+        return None
+
+    version, cached_md5, change_count = payload[:3]
+    if version != METADATA_CACHE_VERSION or cached_md5 != input_md5:
+        return None
+
+    function_table, node_table = payload[3:]
+    node_entries = zip(*node_table)
+    functions = {}
+
+    node_index = 0
+    for address, name, signature, node_count in zip(*function_table):
+        function_metadata = FunctionMetadata.from_cache(address, name, signature)
+
+        # rebuild the nodes of this function
+        function_nodes = node_entries[node_index:node_index+node_count]
+        node_index += node_count
+
+        for node_address, size, node_id, instruction_sizes in function_nodes:
+            node_metadata = NodeMetadata.from_cache(node_address, size, node_id, instruction_sizes)
+            node_metadata.function = function_metadata
+            function_metadata.nodes[node_address] = node_metadata
+
+        function_metadata._finalize()
+        functions[address] = function_metadata
+
+    return (change_count, functions)
+
 #--------------------------------------------------------------------------
 # Async Metadata Helpers
 #--------------------------------------------------------------------------
@@ -888,8 +2296,275 @@ class MetadataDelta(object):
 def collect_function_metadata(function_addresses):
     """
     Collect function metadata for a list of addresses.
+
+    Addresses that do not start a defined function are skipped.
     """
-    return { ea: FunctionMetadata(ea) for ea in function_addresses }
+    output = {}
+    for ea in function_addresses:
+        function = idaapi.get_func(ea)
+        if function and function.startEA == ea:
+            output[ea] = FunctionMetadata(ea)
+    return output
+
+class MetadataCollector(object):
+    """
+    Time budgeted, resumable collection of function metadata.
+
+    Each call to collect() reads from the database for (roughly) no longer
+    than the given time budget. The flowchart of a function that is too big
+    to collect within a single budget is collected across multiple calls.
+
+    Functions within prioritized address ranges are collected ahead of the
+    rest, most recently prioritized ranges first.
+    """
+
+    def __init__(self, function_addresses):
+        self._function_addresses = list(function_addresses)
+        self._index = 0
+
+        # the functions that have yet to be collected, and all requested functions
+        self._pending = set(self._function_addresses)
+        self._known = set(self._function_addresses)
+
+        # functions added by other threads (see add_functions)
+        self._added = []
+
+        # the requested addresses that do not start a defined function
+        self._missing = []
+
+        # the function being collected when the last budget ran out (if any)
+        self._partial = None
+
+        # priority requests from other threads, as (ranges, waiter)
+        self._lock = threading.Lock()
+        self._requests = []
+        self._closed = False
+
+        # the prioritized (start, end) ranges (a stack), and those waiting on them
+        self._priority = []
+        self._waiters = []
+
+        # collection statistics
+        self.completed = 0
+        self.node_count = 0
+        self.elapsed = 0.0
+
+    @property
+    def total(self):
+        """
+        The number of functions to be collected.
+        """
+        return len(self._function_addresses)
+
+    @property
+    def finished(self):
+        """
+        Return a bool indicating if all of the functions have been collected.
+        """
+        return self._index >= len(self._function_addresses) and not (self._partial or self._added)
+
+    @property
+    def throughput(self):
+        """
+        The collection throughput thus far, in functions per second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.completed / self.elapsed
+
+    def prioritize(self, ranges, waiter):
+        """
+        Collect the functions within the given [start, end) ranges first.
+
+        The waiter is returned by pop_waiters() once they have been collected.
+        Returns False if the collector is no longer accepting requests.
+        """
+
+        # the ranges are consumed as a stack, so the first range goes on top
+        ranges = list(ranges)[::-1]
+
+        with self._lock:
+            if self._closed:
+                return False
+            self._requests.append((ranges, waiter))
+        return True
+
+    def add_functions(self, function_addresses, recollect=False):
+        """
+        Add functions to be collected.
+
+        Functions that were already requested are skipped, unless recollect
+        is set (eg, as they have changed since they were collected).
+        Returns False if the collector is no longer accepting functions.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if recollect:
+                self._added.extend(function_addresses)
+            else:
+                self._added.extend(ea for ea in function_addresses if ea not in self._known)
+        return True
+
+    def pop_missing(self):
+        """
+        Pop the requested addresses found not to start a defined function.
+        """
+        missing, self._missing = self._missing, []
+        return missing
+
+    def pop_waiters(self):
+        """
+        Pop the waiters whose prioritized functions have all been collected.
+        """
+        if self._priority or self._partial:
+            return []
+        with self._lock:
+            if self._requests:
+                return []
+        waiters, self._waiters = self._waiters, []
+        return waiters
+
+    def close(self, force=False):
+        """
+        Stop accepting requests, and pop all remaining waiters.
+
+        If functions were added since the collection finished, the collector
+        is left open (and None is returned) so they can be collected, unless
+        the close is forced.
+        """
+        with self._lock:
+            if self._added and not force:
+                return None
+            self._closed = True
+            waiters = self._waiters + [waiter for _, waiter in self._requests]
+            self._requests = []
+        self._waiters = []
+        return waiters
+
+    def _next_function(self, deadline):
+        """
+        Pop the address of the next function to collect (or None).
+        """
+
+        #
+        # the functions within prioritized ranges come first. a range is
+        # walked one function chunk at a time, so each chunk (rather than
+        # each address) costs one lookup, and the rest of the range is put
+        # back on the stack for the next call
+        #
+
+        while self._priority:
+
+            # out of time, the rest of the ranges will wait for the next budget
+            if time.time() >= deadline:
+                return None
+
+            start, end = self._priority.pop()
+
+            chunk = idaapi.get_fchunk(start) or idaapi.get_next_fchunk(start)
+            if not (chunk and chunk.startEA < end):
+                continue
+
+            if chunk.endEA < end:
+                self._priority.append((chunk.endEA, end))
+
+            function = idaapi.get_func(chunk.startEA)
+            if function and function.startEA in self._pending:
+                self._pending.discard(function.startEA)
+                return function.startEA
+
+        # otherwise, continue collecting the functions in order
+        while self._index < len(self._function_addresses):
+            ea = self._function_addresses[self._index]
+            self._index += 1
+
+            if ea not in self._pending:
+                continue
+            self._pending.discard(ea)
+
+            function = idaapi.get_func(ea)
+            if function and function.startEA == ea:
+                return ea
+
+            # not a defined function (anymore)
+            self._missing.append(ea)
+            return None
+
+        # nothing left to collect
+        return None
+
+    @execute_sync(idaapi.MFF_READ)
+    def collect(self, budget):
+        """
+        Collect function metadata for (at most) the given time budget.
+
+        Returns a map of the function metadata completed within the budget.
+        Addresses that do not start a defined function are skipped.
+        """
+        start = time.time()
+        deadline = start + budget
+        output = {}
+
+        #
+        # take in any functions added since the last budget, and any new
+        # priority requests (the newest on top of the stack)
+        #
+
+        with self._lock:
+            requests, self._requests = self._requests, []
+            for ea in self._added:
+                self._known.add(ea)
+                self._pending.add(ea)
+                self._function_addresses.append(ea)
+            self._added = []
+        for ranges, waiter in requests:
+            self._priority.extend(ranges)
+            self._waiters.append(waiter)
+
+        while not self.finished:
+
+            # resume collecting a function that was paused by the last budget
+            if self._partial:
+                function_metadata, flowchart, node_id = self._partial
+
+            # or start collecting the next function
+            else:
+
+                # out of time, the next function will start the next budget
+                if time.time() >= deadline:
+                    break
+
+                ea = self._next_function(deadline)
+                if ea is None:
+                    continue
+
+                function_metadata = FunctionMetadata(ea, build=False)
+                function_metadata._refresh_name()
+                flowchart = function_metadata._get_flowchart()
+                node_id = 0
+
+            # collect the function nodes until they are done, or time runs out
+            node_id = function_metadata._collect_nodes(flowchart, node_id, deadline)
+            if node_id < flowchart.size():
+                self._partial = (function_metadata, flowchart, node_id)
+                break
+            self._partial = None
+
+            # all of the nodes have been collected, the function is complete
+            function_metadata._finalize()
+            function_metadata.signature = get_function_signature(function_metadata.address)
+            output[function_metadata.address] = function_metadata
+
+            self.completed += 1
+            self.node_count += function_metadata.node_count
+
+        # the prioritized ranges that remain are irrelevant once finished
+        if self.finished:
+            self._priority = []
+
+        self.elapsed += time.time() - start
+        return output
 
 @idafast
 def metadata_progress(completed, total):
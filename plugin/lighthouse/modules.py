@@ -0,0 +1,246 @@
+import re
+import struct
+import logging
+import operator
+import itertools
+
+import idc
+import idaapi
+import idautils
+
+from lighthouse.util import BlockHitmap, address_array, count_array
+from lighthouse.parsers import DrcovData
+
+logger = logging.getLogger("Lighthouse.Modules")
+
+#------------------------------------------------------------------------------
+# Module Mapping
+#------------------------------------------------------------------------------
+#
+#    Coverage logs record their basic blocks as offsets into the modules
+#    (.EXE, .DLL, ...) that were loaded by the traced process. To map these
+#    blocks into the database, they must be rebased onto wherever each of
+#    those modules lives in the database.
+#
+#    Most databases hold a single module (the root binary) at its image
+#    base. But a database can also hold additional modules, such as DLLs
+#    that were manually loaded, or firmware overlays mapped at other bases.
+#
+#    The mapping layer defined in this file describes each module of the
+#    database as a DatabaseModule. The modules of a coverage log are then
+#    matched against these by checksum & timestamp, path, or name, and the
+#    blocks of every matching module are rebased together, in one pass.
+#
+
+# the file extensions of images that a segment name can be derived from
+_IMAGE_SEGMENT = re.compile(
+    r"^(?P<name>[^:]+?\.(?:dll|exe|sys|ocx|drv|efi|bin|dylib|ko|so(?:\.\d+)*))(?:[:_.].*)?$",
+    re.IGNORECASE
+)
+
+class DatabaseModule(object):
+    """
+    A module (image) that resides in the database.
+    """
+
+    def __init__(self, name, path, base, end, checksum=0, timestamp=0):
+        self.name = name
+        self.path = path
+        self.base = base
+        self.end  = end
+        self.checksum  = checksum
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "DatabaseModule(%r, base=0x%X)" % (self.name, self.base)
+
+    def match(self, drcov_module):
+        """
+        Return the strength of the match against a drcov module, or 0.
+
+        The (PE) checksum and timestamp of a module identify it best, then
+        its full path, and last its filename.
+        """
+        if self.checksum and self.timestamp \
+            and self.checksum == drcov_module.checksum \
+            and self.timestamp == drcov_module.timestamp:
+            return 3
+
+        if self.path and _normalize_path(self.path) == _normalize_path(drcov_module.path):
+            return 2
+
+        if self.name.lower() == _normalize_path(drcov_module.path).rsplit("/", 1)[-1]:
+            return 1
+
+        return 0
+
+def _normalize_path(path):
+    """
+    Normalize a filepath for comparison across platforms.
+
+    NOTE: a log may have been collected on a different platform than the
+    one it is loaded on, so this can not rely on os.path.
+    """
+    return path.replace("\\", "/").lower()
+
+def get_database_modules():
+    """
+    Get the modules (DatabaseModule) that reside in the database.
+
+    The root binary is always the first module returned.
+    """
+    root_name = idaapi.get_root_filename()
+    checksum, timestamp = _get_pe_identity()
+
+    # the root binary of the database
+    modules = [
+        DatabaseModule(
+            root_name,
+            idaapi.get_input_file_path(),
+            idaapi.get_imagebase(),
+            idaapi.cvar.inf.maxEA,
+            checksum,
+            timestamp
+        )
+    ]
+
+    #
+    # the database does not track additional modules as such, but their
+    # segments are named after them when they are loaded into the database
+    # (eg, 'kernel32.dll', 'kernel32.dll:.text', 'overlay.bin'). we group
+    # the segments by the image name they carry, and assume each module
+    # starts at its lowest segment (ie, its headers)
+    #
+
+    extents = {}
+    for segment_address in idautils.Segments():
+        match = _IMAGE_SEGMENT.match(idc.SegName(segment_address) or "")
+        if not match:
+            continue
+
+        name = match.group("name")
+        if name.lower() == root_name.lower():
+            continue
+
+        start = idc.SegStart(segment_address)
+        end = idc.SegEnd(segment_address)
+
+        extent = extents.setdefault(name.lower(), [name, start, end])
+        extent[1] = min(extent[1], start)
+        extent[2] = max(extent[2], end)
+
+    for name, start, end in sorted(extents.itervalues(), key=lambda x: x[1]):
+        modules.append(DatabaseModule(name, "", start, end))
+
+    logger.debug("Database modules: %s" % modules)
+    return modules
+
+def _get_pe_identity():
+    """
+    Get the (checksum, timestamp) of the root binary, if it is a PE.
+    """
+
+    #
+    # the PE header saved in the database is an IMAGE_NT_HEADERS. the
+    # TimeDateStamp of its file header is found at offset 8, and the
+    # CheckSum of its optional header is found at offset 88 (PE32/PE32+)
+    #
+
+    try:
+        header = idautils.peutils_t().header()
+        return struct.unpack_from("<I", header, 88)[0], struct.unpack_from("<I", header, 8)[0]
+
+    # not a PE, or this version of IDA does not expose its header
+    except Exception:
+        return (0, 0)
+
+def match_modules(database_modules, drcov_modules):
+    """
+    Match drcov modules against the modules of the database.
+
+    Returns a map of drcov module id --> index of its database module.
+    """
+    matches = {}
+
+    for drcov_module in drcov_modules:
+        best_index, best_strength = None, 0
+
+        # find the database module that best matches this drcov module
+        for index, database_module in enumerate(database_modules):
+            strength = database_module.match(drcov_module)
+            if strength > best_strength:
+                best_index, best_strength = index, strength
+
+        if best_index is not None:
+            matches[drcov_module.id] = best_index
+
+    return matches
+
+def rebase_module_blocks(module_blocks, database_modules):
+    """
+    Rebase the coverage blocks of matched modules onto the database.
+
+    The given module blocks are a list of (module index, starts, sizes)
+    for each database module that the coverage was matched against.
+
+    Returns a BlockHitmap of the rebased blocks.
+    """
+
+    #
+    # the blocks of each module are offsets from the base of the module.
+    # we rebase the blocks of all modules onto the database in one pass,
+    # by pairing each block with the base of the module it came from
+    #
+
+    bases = itertools.chain.from_iterable(
+        itertools.repeat(database_modules[module_index].base, len(starts))
+        for module_index, starts, _ in module_blocks
+    )
+    starts = itertools.chain.from_iterable(starts for _, starts, _ in module_blocks)
+    sizes = itertools.chain.from_iterable(sizes for _, _, sizes in module_blocks)
+
+    return BlockHitmap(
+        address_array(itertools.imap(operator.add, starts, bases)),
+        count_array(sizes)
+    )
+
+#------------------------------------------------------------------------------
+# Concurrent Loading
+#------------------------------------------------------------------------------
+
+def load_module_coverage(task):
+    """
+    Parse a drcov log and extract the coverage blocks of all matching modules.
+
+    This is intended to be dispatched to pool workers, so any error is
+    handed back to the caller rather than raised.
+
+    Returns a tuple of (filepath, module_blocks, error) where module_blocks is
+    a list of (database module index, starts, sizes) for each matched module.
+    """
+    filepath, database_modules = task
+
+    # parse the log and extract the blocks of every matched module
+    try:
+        data = DrcovData(filepath, use_mmap=True)
+        try:
+            matches = match_modules(database_modules, data.modules)
+            if not matches:
+                raise ValueError("No modules in the coverage data match the database")
+
+            # bucket the blocks of all modules with a single pass of the table
+            buckets = data.split_by_module()
+
+        finally:
+            data.close()
+
+    # failed to load the log, hand the error back to the caller
+    except Exception as e:
+        return (filepath, None, str(e))
+
+    module_blocks = []
+    for mod_id, (starts, sizes) in sorted(buckets.iteritems()):
+        if mod_id in matches:
+            module_blocks.append((matches[mod_id], starts, sizes))
+
+    return (filepath, module_blocks, None)
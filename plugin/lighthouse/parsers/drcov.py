@@ -1,9 +1,13 @@
 #!/usr/bin/python
 
 import os
+import io
+import re
 import sys
 import mmap
+import array
 import struct
+import itertools
 from ctypes import *
 
 #------------------------------------------------------------------------------
@@ -13,12 +17,37 @@ from ctypes import *
 class DrcovData(object):
     """
     A drcov log parser.
+
+    When use_mmap is set, the log is memory mapped and the basic block
+    table is exposed as a typed view directly over the mapped file. This
+    avoids reading (copying) the entire table into memory, keeping parse
+    time and memory usage flat regardless of the log size.
+
+    Alternatively, an in-memory drcov log can be given as 'data'. This can
+    be any object supporting the buffer protocol (str, bytearray, memoryview,
+    mmap, ...) and its basic block table is viewed in place, without a copy.
+
+    When follow is set, the log is one that is still being written (eg, by a
+    fuzzer) and it is kept open. Only the header and module table are parsed
+    up front, and the basic blocks appended to the log are read as they
+    arrive, with read_new_blocks().
     """
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, use_mmap=False, data=None, follow=False):
 
-        # original filepath
+        # original filepath (or a name to identify the given data by)
         self.filepath = filepath
 
+        # memory mapped view of the log file (use_mmap only)
+        self._use_mmap = use_mmap
+        self._mapping  = None
+
+        # the in-memory log backing the basic block table view (if any)
+        self._data = None
+
+        # the open log file, and any partial entry read from it (follow only)
+        self._file = None
+        self._remainder = ""
+
         # drcov header attributes
         self.version = 0
         self.flavor  = None
@@ -27,39 +56,165 @@ class DrcovData(object):
         self.module_table_count   = 0
         self.module_table_version = 0
         self.modules = []
+        self._modules_by_name = {}
 
         # drcov basic block data
         self.bb_table_count     = 0
         self.bb_table_is_binary = True
         self.basic_blocks = []
 
-        # parse the given filepath
-        self._parse_drcov_file(filepath)
+        # decoded (columnar) basic block data, see _get_bb_columns()
+        self._bb_columns = None
+
+        # parse the given data, or filepath
+        if data is not None:
+            self._parse_drcov_data(data)
+        elif follow:
+            self._parse_drcov_follow(filepath)
+        else:
+            self._parse_drcov_file(filepath)
 
     #--------------------------------------------------------------------------
     # Public
     #--------------------------------------------------------------------------
 
+    def get_module(self, module_name):
+        """
+        Get the module (DrcovModule) that matches the given module_name.
+        """
+        try:
+            return self._modules_by_name[module_name.lower()]
+
+        # failed to find a module that matches the given name, bail
+        except KeyError:
+            raise ValueError("Failed to find module '%s' in coverage data" % module_name)
+
     def filter_by_module(self, module_name):
         """
         Extract coverage blocks pertaining to the named module.
+
+        Returns a list of (start, size) tuples.
         """
+        starts, sizes = self.get_blocks_by_module(module_name)
+        return zip(starts, sizes)
 
-        # locate the coverage that matches the given module_name
-        for module in self.modules:
-            if module.filename.lower() == module_name.lower():
-                mod_id = module.id
-                break
+    def get_blocks_by_module(self, module_name):
+        """
+        Extract coverage blocks pertaining to the named module.
 
-        # failed to find a module that matches the given name, bail
+        Returns parallel (starts, sizes) arrays.
+        """
+        module = self.get_module(module_name)
+        return self._select_blocks(module.id)
+
+    def split_by_module(self):
+        """
+        Extract coverage blocks for every module in the coverage data at once.
+
+        Returns a map of module id --> parallel (starts, sizes) arrays.
+        """
+        return self._bucket_blocks()
+
+    def read_new_blocks(self):
+        """
+        Read the basic blocks appended to a followed log since the last read.
+
+        Returns a map of module id --> parallel (starts, sizes) arrays of the
+        new blocks, like split_by_module().
+        """
+        assert self._file, "Coverage data is not following a log file"
+
+        #
+        # the writer of the log may be in the middle of writing an entry,
+        # so only whole entries are parsed. the trailing partial entry (if
+        # any) is held on to, and completed by the next read
+        #
+
+        data = self._remainder + (self._file.read() or "")
+
+        # binary entries are a fixed size
+        if self.bb_table_is_binary:
+            split = len(data) - (len(data) % sizeof(DrcovBasicBlock))
+            data, self._remainder = data[:split], data[split:]
+            starts, sizes, mod_ids = _decode_bb_table(data)
+
+        # text entries are whole lines
         else:
-            raise ValueError("Failed to find module '%s' in coverage data" % module_name)
+            split = data.rfind("\n") + 1
+            data, self._remainder = data[:split], data[split:]
+            starts  = array.array("I")
+            sizes   = array.array("H")
+            mod_ids = array.array("H")
+            self._parse_bb_text_chunk(data, starts, sizes, mod_ids)
+            mod_ids = mod_ids.tostring()
+
+        self.bb_table_count += len(starts)
+        return _bucket_blocks(starts, sizes, mod_ids)
+
+    def _select_blocks(self, mod_id):
+        """
+        Extract the (starts, sizes) arrays for blocks of the given module id.
+        """
+        buckets = self._bucket_blocks(mod_id)
+        return buckets.get(mod_id, (array.array("I"), array.array("H")))
+
+    def _bucket_blocks(self, mod_id=None):
+        """
+        Bucket the basic block table into (starts, sizes) arrays by module id.
+
+        If a mod_id is given, only blocks for that module are bucketed.
+        """
+        starts, sizes, mod_ids = self._get_bb_columns()
+        return _bucket_blocks(starts, sizes, mod_ids, mod_id)
+
+    def _get_bb_columns(self):
+        """
+        Decode the basic block table into compact columns.
+
+        Returns a tuple of (starts, sizes, mod_ids) where mod_ids is a string.
+        """
+        if self._bb_columns:
+            return self._bb_columns
+
+        # save the decoded columns for any subsequent extractions
+        self._bb_columns = _decode_bb_table(buffer(self.basic_blocks))
+        return self._bb_columns
+
+    def close(self):
+        """
+        Release the memory mapped log file or data backing this coverage data.
+
+        NOTE: basic_blocks is a view of the mapped file, so it is dropped too.
+        The mapped file can not be released while anything else still holds
+        on to basic_blocks (or one of its entries), as that would leave them
+        pointing at unmapped memory.
+        """
+
+        #
+        # the basic block view (and every entry taken from it) references the
+        # mapping, so anything beyond our own reference (and the one made by
+        # getrefcount itself) means a view of the mapping is still alive
+        #
 
-        # loop through the coverage data and filter out data for only this module
-        coverage_blocks = [(bb.start, bb.size) for bb in self.basic_blocks if bb.mod_id == mod_id]
+        if self._mapping and sys.getrefcount(self.basic_blocks) > 2:
+            raise BufferError("Basic blocks of the mapped log are still in use")
 
-        # return the filtered coverage blocks
-        return coverage_blocks
+        # stop following the log file
+        if self._file:
+            self._file.close()
+            self._file = None
+
+        if not self._data:
+            return
+
+        # drop the view of the data before releasing the data itself
+        self.basic_blocks = []
+        self._data = None
+
+        # release the mapped log file
+        if self._mapping:
+            self._mapping.close()
+            self._mapping = None
 
     #--------------------------------------------------------------------------
     # Parsing Routines - Top Level
@@ -69,16 +224,73 @@ class DrcovData(object):
         """
         Parse drcov coverage from the given log file.
         """
+        if self._use_mmap:
+            self._parse_drcov_mapping(filepath)
+            return
+
         with open(filepath, "rb") as f:
             self._parse_drcov_header(f)
             self._parse_module_table(f)
             self._parse_bb_table(f)
 
+    def _parse_drcov_mapping(self, filepath):
+        """
+        Parse drcov coverage from the given log file, by memory mapping it.
+        """
+
+        #
+        # NOTE: the file is mapped copy-on-write, rather than read-only, as
+        # ctypes can only view writable buffers in a way that keeps them
+        # alive for as long as the view. nothing is ever written to it, so
+        # this costs no more memory than a read-only mapping would
+        #
+
+        with open(filepath, "rb") as f:
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        # parse the mapped file as if it were any other in-memory log
+        self._parse_drcov_data(self._mapping)
+
+    def _parse_drcov_follow(self, filepath):
+        """
+        Parse drcov coverage from the given log file, up to its basic blocks.
+        """
+
+        #
+        # NOTE/COMPAT: the log is opened unbuffered, as a buffered file that
+        # has reached its end (eg, under newer glibc) will not return any of
+        # the data that is appended to it afterwards
+        #
+
+        self._file = io.open(filepath, "rb", buffering=0)
+
+        # the basic blocks are left to be read with read_new_blocks()
+        try:
+            self._parse_drcov_header(self._file)
+            self._parse_module_table(self._file)
+            self._parse_bb_table_header(self._file)
+
+        # the log may not have been written up to its basic blocks yet
+        except Exception:
+            self.close()
+            raise
+
     def _parse_drcov_data(self, drcov_data):
         """
         Parse drcov coverage from the given data blob.
         """
-        pass # TODO
+        self._data = drcov_data
+
+        #
+        # the header and module table are (small) lines of text, so we parse
+        # them out of the data through a simple filestream-like wrapper. the
+        # basic block table is then viewed in place (see _view_buffer)
+        #
+
+        f = BufferStream(drcov_data)
+        self._parse_drcov_header(f)
+        self._parse_module_table(f)
+        self._parse_bb_table(f)
 
     #--------------------------------------------------------------------------
     # Parsing Routines - Internals
@@ -200,6 +412,9 @@ class DrcovData(object):
             module = DrcovModule(f.readline().strip(), self.module_table_version)
             self.modules.append(module)
 
+            # the first module of a given name takes precedence in lookups
+            self._modules_by_name.setdefault(module.filename.lower(), module)
+
     def _parse_bb_table(self, f):
         """
         Parse dcov log basic block table from filestream.
@@ -228,10 +443,10 @@ class DrcovData(object):
         token = "module id"
         saved_position = f.tell()
 
-        # is this an ascii table?
+        # is this an ascii table? if so, consume the rest of its column line
         if f.read(len(token)) == token:
             self.bb_table_is_binary = False
-            raise ValueError("ASCII DrCov logs are not supported at this time.")
+            f.readline()
 
         # nope! binary table, seek back to the start of the table
         else:
@@ -243,12 +458,324 @@ class DrcovData(object):
         Parse drcov log basic block table entries from filestream.
         """
 
+        # NOTE/COMPAT: some drcov configurations emit the table as text
+        if not self.bb_table_is_binary:
+            self._parse_bb_table_text_entries(f)
+            return
+
+        table_type = DrcovBasicBlock * self.bb_table_count
+
+        #
+        # if the filestream wraps an in-memory log (or a memory mapped file),
+        # we can simply overlay the ctypes structure array directly onto the
+        # basic block table as it sits in memory (no copy)
+        #
+
+        if isinstance(f, BufferStream):
+            self.basic_blocks = _view_buffer(table_type, f.data, f.tell())
+            return
+
         # allocate the ctypes structure array of basic blocks
-        self.basic_blocks = (DrcovBasicBlock * self.bb_table_count)()
+        self.basic_blocks = table_type()
 
         # read the basic block entries directly into the newly allocated array
         f.readinto(self.basic_blocks)
 
+    def _parse_bb_table_text_entries(self, f):
+        """
+        Parse drcov log (ascii) basic block table entries from filestream.
+
+        -------------------------------------------------------------------
+
+        Format used by drcov when dumping its log as text
+           eg: 'module[  4]: 0x0000000000001000,  32'
+
+        """
+        CHUNK_SIZE = 4 * 1024 * 1024
+        starts  = array.array("I")
+        sizes   = array.array("H")
+        mod_ids = array.array("H")
+
+        #
+        # text tables can span millions of lines, so rather than splitting the
+        # table one line at a time, we read it in large chunks and extract the
+        # fields of every entry in the chunk at once.
+        #
+        # the extracted fields are then converted in bulk, straight into the
+        # same compact columns used for binary basic block tables.
+        #
+
+        remainder = ""
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+
+            # reached the end of the table, parse whatever is left over
+            if not chunk:
+                self._parse_bb_text_chunk(remainder, starts, sizes, mod_ids)
+                break
+
+            # only parse up to the last whole line in this chunk
+            chunk = remainder + chunk
+            split = chunk.rfind("\n") + 1
+            chunk, remainder = chunk[:split], chunk[split:]
+
+            self._parse_bb_text_chunk(chunk, starts, sizes, mod_ids)
+
+        # ensure the table held as many entries as its header claimed
+        if len(starts) != self.bb_table_count:
+            raise ValueError("Expected %u basic blocks in the table, found %u" \
+                % (self.bb_table_count, len(starts)))
+
+        # save the parsed table in the same form as decoded binary tables
+        self._bb_columns = (starts, sizes, mod_ids.tostring())
+
+        #
+        # finally, pack the parsed columns into a binary basic block table so
+        # that the basic_blocks array is available for text tables as well
+        #
+
+        table = array.array("H", [0]) * (len(starts) * 4)
+        start_halves = array.array("H", starts.tostring())
+        table[0::4] = start_halves[0::2]
+        table[1::4] = start_halves[1::2]
+        table[2::4] = sizes
+        table[3::4] = mod_ids
+
+        self.basic_blocks = (DrcovBasicBlock * len(starts)).from_buffer(table)
+
+    def _parse_bb_text_chunk(self, chunk, starts, sizes, mod_ids):
+        """
+        Parse a chunk of (ascii) basic block table entries into the given columns.
+        """
+
+        #
+        # strip the punctuation from the entries in this chunk of text, and
+        # split them into a flat list of fields. this leaves us with exactly
+        # four fields per entry, eg:
+        #
+        #   'module[  4]: 0x0000000000001000,  32' --> 'module', '4', '0x..', '32'
+        #
+
+        fields = chunk.translate(None, "[]:,").split()
+        if len(fields) % 4:
+            raise ValueError("Malformed entries in the ascii basic block table")
+
+        # convert each (strided) column of string fields in bulk
+        count = len(fields) // 4
+        starts.extend(array.array("I", map(int, fields[2::4], itertools.repeat(16, count))))
+        sizes.extend(array.array("H", map(int, fields[3::4])))
+        mod_ids.extend(array.array("H", map(int, fields[1::4])))
+
+#------------------------------------------------------------------------------
+# Buffer Helpers
+#------------------------------------------------------------------------------
+
+class BufferStream(object):
+    """
+    A minimal, read-only filestream over an in-memory buffer.
+    """
+    READ_SIZE = 256
+
+    def __init__(self, data):
+        self.data = data
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        self._position = position
+
+    def read(self, size):
+        chunk = self.data[self._position:self._position+size]
+        self._position += len(chunk)
+
+        # normalize the sliced chunk to a str (memoryview, bytearray, ...)
+        if isinstance(chunk, memoryview):
+            return chunk.tobytes()
+        return str(chunk)
+
+    def readline(self):
+        start = self._position
+        line = ""
+
+        # read forward in small chunks until a newline is found (or eof)
+        while True:
+            chunk = self.read(self.READ_SIZE)
+            index = chunk.find("\n")
+
+            # found the end of the line
+            if index != -1:
+                line += chunk[:index+1]
+                break
+
+            line += chunk
+
+            # reached the end of the buffer
+            if len(chunk) < self.READ_SIZE:
+                break
+
+        # move the stream position to just past the line we consumed
+        self._position = start + len(line)
+        return line
+
+class Py_buffer(Structure):
+    """
+    The (python 2.7) C structure used by the 'new-style' buffer interface.
+    """
+    _fields_ = [
+        ('buf',        c_void_p),
+        ('obj',        c_void_p),
+        ('len',        c_ssize_t),
+        ('itemsize',   c_ssize_t),
+        ('readonly',   c_int),
+        ('ndim',       c_int),
+        ('format',     c_char_p),
+        ('shape',      c_void_p),
+        ('strides',    c_void_p),
+        ('suboffsets', c_void_p),
+        ('smalltable', c_ssize_t * 2),
+        ('internal',   c_void_p)
+    ]
+
+def _view_buffer(ctype, data, offset):
+    """
+    Create a ctypes view of the given buffer object at the given offset.
+
+    The view holds a reference to 'data', keeping it alive with the view.
+    """
+
+    # writable buffers (bytearray, writable mmap, ...) are the easy case
+    try:
+        return ctype.from_buffer(data, offset)
+    except TypeError:
+        pass
+
+    #
+    # ctypes refuses to create views of read-only buffers (str, read-only
+    # mmap, memoryview, ...) so we must locate the memory backing the buffer
+    # ourselves, and overlay the ctypes type on it by address.
+    #
+
+    address = c_void_p()
+    length  = c_ssize_t()
+
+    # python 2.7 memoryviews only support the 'new-style' buffer interface
+    if isinstance(data, memoryview):
+        view = Py_buffer()
+        pythonapi.PyObject_GetBuffer(py_object(data), byref(view), 0)
+        address.value, length.value = view.buf, view.len
+        pythonapi.PyBuffer_Release(byref(view))
+
+    # everything else should support the 'old-style' buffer interface
+    else:
+        pythonapi.PyObject_AsReadBuffer(py_object(data), byref(address), byref(length))
+
+    # ensure the requested view doesn't run off the end of the buffer
+    if offset + sizeof(ctype) > length.value:
+        raise ValueError("Buffer size too small (%u instead of at least %u bytes)" \
+            % (length.value, offset + sizeof(ctype)))
+
+    #
+    # a view created by address knows nothing of the memory it is overlaid
+    # on, so we attach the buffer to the view ourselves. entries taken from
+    # the view reference the view, so they keep the buffer alive as well
+    #
+
+    view = ctype.from_address(address.value + offset)
+    view._buffer = data
+    return view
+
+#------------------------------------------------------------------------------
+# Basic Block Table Helpers
+#------------------------------------------------------------------------------
+
+# the number of basic block entries decoded at a time (512KB worth)
+BB_DECODE_CHUNK = 0x10000
+
+def _decode_bb_table(raw):
+    """
+    Decode a raw (binary) basic block table into compact columns.
+
+    Returns a tuple of (starts, sizes, mod_ids) where mod_ids is a string.
+    """
+    chunk_size = BB_DECODE_CHUNK * sizeof(DrcovBasicBlock)
+
+    starts  = array.array("I")
+    sizes   = array.array("H")
+    mod_ids = array.array("H")
+
+    #
+    # the basic block table is a packed array of 8 byte bb_entry_t's. we
+    # can view the raw table as arrays of 32bit or 16bit words and use
+    # strided slices to pull out each field as its own column.
+    #
+    #   bb_entry_t: | start (4) | size (2) | mod_id (2) |
+    #
+    # the table is decoded a chunk at a time, so that only the words of a
+    # single chunk are ever held in memory alongside the decoded columns.
+    #
+
+    for offset in xrange(0, len(raw), chunk_size):
+        chunk = raw[offset:offset+chunk_size]
+
+        words = array.array("I", chunk)
+        starts.extend(words[0::2])
+
+        halves = array.array("H", chunk)
+        sizes.extend(halves[2::4])
+        mod_ids.extend(halves[3::4])
+
+    return (starts, sizes, mod_ids.tostring())
+
+def _bucket_blocks(starts, sizes, mod_ids, mod_id=None):
+    """
+    Bucket decoded basic block columns into (starts, sizes) arrays by module id.
+
+    If a mod_id is given, only blocks for that module are bucketed.
+    """
+    wanted = struct.pack("H", mod_id) if mod_id is not None else None
+    buckets = {}
+
+    #
+    # blocks in the table are stored in the order they were first
+    # executed, which means blocks of the same module tend to appear in
+    # long, consecutive runs.
+    #
+    # rather than checking the mod_id of each block in python, we let the
+    # regex engine split the mod_id column into runs of identical ids. the
+    # blocks in each run can then be bucketed as whole array slices.
+    #
+
+    for run in _MOD_ID_RUNS.finditer(mod_ids):
+        key = run.group(1)
+
+        # skip runs belonging to modules we were not asked for
+        if wanted and key != wanted:
+            continue
+
+        # get (or create) the bucket for this module's blocks
+        bucket = buckets.get(key, None)
+        if not bucket:
+            bucket = buckets[key] = (array.array("I"), array.array("H"))
+
+        # mod_ids holds 2 bytes per block, convert to block indexes
+        start, end = run.start() >> 1, run.end() >> 1
+
+        # add this run of blocks to the module's bucket
+        bucket[0].extend(starts[start:end])
+        bucket[1].extend(sizes[start:end])
+
+    # return the buckets keyed by (integer) module id
+    return { struct.unpack("H", key)[0]: bucket for key, bucket in buckets.iteritems() }
+
+#
+# matches a run of identical (2 byte) module ids in the decoded mod_id column.
+# each match consumes a multiple of 2 bytes, so matches stay aligned to ids
+#
+
+_MOD_ID_RUNS = re.compile(r"(..)\1*", re.DOTALL)
+
 #------------------------------------------------------------------------------
 # drcov module parser
 #------------------------------------------------------------------------------
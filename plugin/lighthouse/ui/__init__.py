@@ -1,6 +1,7 @@
 import idaapi
 
 from .coverage_overview import *
+from .coverage_loading import CoverageLoadingDialog
 
 #------------------------------------------------------------------------------
 # IDA Action Handler Stub
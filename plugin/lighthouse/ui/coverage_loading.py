@@ -0,0 +1,131 @@
+import logging
+from lighthouse.util import *
+
+logger = logging.getLogger("Lighthouse.UI.Loading")
+
+#------------------------------------------------------------------------------
+# Constants Definitions
+#------------------------------------------------------------------------------
+
+# the interval (in milliseconds) at which the pipeline progress is polled
+POLL_INTERVAL = 100
+
+# the labels shown for the progress of each pipeline stage
+STAGE_LABELS = \
+{
+    "parse":     "Parsed",
+    "normalize": "Normalized",
+    "map":       "Mapped",
+    "merge":     "Merged",
+}
+
+#------------------------------------------------------------------------------
+# Coverage Loading Dialog
+#------------------------------------------------------------------------------
+
+class CoverageLoadingDialog(QtWidgets.QProgressDialog):
+    """
+    A non-modal progress dialog for a running CoveragePipeline.
+
+    The pipeline does all of its work in the background, so this dialog
+    simply polls it from the mainthread to report its progress. Unlike the
+    IDA wait box, the user can keep working in IDA while coverage loads.
+    """
+
+    #
+    # the pipeline can not touch the UI from its own threads, so these
+    # signals are fired (on the mainthread) as the pipeline is polled
+    #
+
+    firstCoverageLoaded = QtCore.pyqtSignal(str)
+    loadingFinished = QtCore.pyqtSignal()
+
+    def __init__(self, pipeline, parent=None):
+        super(CoverageLoadingDialog, self).__init__(parent)
+        self.setObjectName(self.__class__.__name__)
+        self._pipeline = pipeline
+
+        # whether the first coverage surfaced by the pipeline was signaled
+        self._signaled_first = False
+
+        # configure the widget for use
+        self._ui_init()
+
+    #--------------------------------------------------------------------------
+    # Initialization - UI
+    #--------------------------------------------------------------------------
+
+    def _ui_init(self):
+        """
+        Initialize UI elements.
+        """
+        self.setWindowTitle("Loading Coverage")
+        self.setWindowModality(QtCore.Qt.NonModal)
+        self.setMinimumDuration(0)
+        self.setRange(0, self._pipeline.total * len(self._pipeline.STAGES))
+
+        # the dialog is closed by us once the pipeline has wound down
+        self.setAutoClose(False)
+        self.setAutoReset(False)
+
+        # font
+        self.setFont(MonospaceFont())
+
+        # connect signals
+        self.canceled.connect(self._pipeline.cancel)
+
+        # poll the pipeline for progress
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._ui_poll_pipeline)
+        self._timer.start(POLL_INTERVAL)
+
+        self.refresh()
+
+    #--------------------------------------------------------------------------
+    # Signal Handlers
+    #--------------------------------------------------------------------------
+
+    def _ui_poll_pipeline(self):
+        """
+        Handle a poll of the pipeline progress.
+        """
+        pipeline = self._pipeline
+
+        # signal the first coverage surfaced by the pipeline, so it can be shown
+        if pipeline.loaded and not self._signaled_first:
+            self._signaled_first = True
+            self.firstCoverageLoaded.emit(pipeline.loaded[0])
+
+        # the pipeline is still running, update the dialog
+        if not pipeline.finished:
+            self.refresh()
+            return
+
+        # the pipeline has wound down, tear down the dialog
+        self._timer.stop()
+        self.canceled.disconnect(self._pipeline.cancel)
+        self.close()
+        self.loadingFinished.emit()
+
+    #--------------------------------------------------------------------------
+    # Refresh
+    #--------------------------------------------------------------------------
+
+    def refresh(self):
+        """
+        Refresh the dialog with the progress of each pipeline stage.
+        """
+        pipeline = self._pipeline
+        progress = pipeline.progress
+
+        # the pipeline is dropping its pending work
+        if pipeline.cancelled:
+            self.setLabelText("Cancelling...")
+            return
+
+        lines = []
+        for stage in pipeline.STAGES:
+            lines.append("%-10s %u/%u" % (STAGE_LABELS[stage], progress[stage], pipeline.total))
+
+        self.setLabelText("\n".join(lines))
+        self.setValue(sum(progress.itervalues()))
@@ -262,6 +262,7 @@ class CoverageOverview(idaapi.PluginForm):
         # register for cues from the director
         self._director.coverage_switched(self._coverage_changed) # TODO: too heavy
         self._director.coverage_modified(self._coverage_changed)
+        self._director.function_renamed(self._coverage_changed)
 
     def _ui_layout(self):
         """
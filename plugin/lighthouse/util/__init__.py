@@ -1,6 +1,9 @@
 from .ida import *
 from .misc import *
 from .debug import *
+from .hitmap import CompactHitmap, AddressSet, InstructionBitmap, address_array, count_array, address_hash
+from .intervals import IntervalSet
+from .blocks import BlockHitmap
 from .log import lmsg, logging_started, start_logging
 from .qtshim import using_pyqt5, QtCore, QtGui, QtWidgets
 
@@ -0,0 +1,163 @@
+import heapq
+import operator
+import itertools
+
+from .hitmap import CompactHitmap, address_array, count_array
+from .intervals import IntervalSet, _is_sorted
+
+#------------------------------------------------------------------------------
+# Block Hitmap
+#------------------------------------------------------------------------------
+#
+#    Coverage is collected (and loaded) as basic blocks, but is mapped to
+#    the database as the individual instructions those blocks execute. A
+#    trace that is expanded to instructions up front is usually 5-10x the
+#    size of the blocks it came from, and the expansion is only as good as
+#    the metadata available at the time it was made.
+#
+#    A BlockHitmap holds coverage as the blocks themselves: a map of unique
+#    (start, size) block --> number of executions, stored as three parallel
+#    arrays sorted by block. It is expanded to an instruction-level
+#    CompactHitmap against the database metadata only when (and each time)
+#    that is needed, eg. when a coverage set is mapped for painting.
+#
+
+class BlockHitmap(object):
+    """
+    A compact hitmap of (start, size) block --> hit count, backed by sorted arrays.
+    """
+
+    def __init__(self, starts=(), sizes=()):
+        self.starts = address_array()
+        self.sizes  = count_array()
+        self.counts = count_array()
+
+        # nothing to build
+        if not starts:
+            return
+
+        #
+        # blocks that are already sorted and unique (eg, the blocks of an
+        # existing block hitmap) can be adopted without any work
+        #
+
+        if _is_sorted(starts, strict=True):
+            self.starts = address_array(starts)
+            self.sizes = count_array(sizes)
+            self.counts = count_array([1]) * len(self.starts)
+            return
+
+        #
+        # a drcov block table is not. its blocks are listed in the order
+        # they were translated, and a block that is translated again (eg,
+        # after a code cache flush) appears in the table more than once.
+        #
+        # sorting (start, size) tuples to count the unique blocks is slow,
+        # so each block is instead packed into a single integer key with
+        # its size held in the low bits. the keys sort (and compare) as
+        # plain integers, and the hits of each unique block are the length
+        # of its run of equal keys in the sorted list
+        #
+
+        shift = max(sizes).bit_length()
+        keys = map(operator.or_, itertools.imap(operator.lshift, starts, itertools.repeat(shift)), sizes)
+        keys.sort()
+
+        # the (exclusive) end index of each run of equal keys
+        ends = list(itertools.compress(
+            itertools.count(1),
+            itertools.imap(operator.ne, keys, itertools.islice(keys, 1, None))
+        ))
+        ends.append(len(keys))
+
+        # unpack the key of each run, and count its length as the block hits
+        keys = map(keys.__getitem__, itertools.imap(operator.sub, ends, itertools.repeat(1)))
+        self.starts = address_array(map(operator.rshift, keys, itertools.repeat(shift, len(keys))))
+        self.sizes  = count_array(map(operator.and_, keys, itertools.repeat((1 << shift) - 1, len(keys))))
+        self.counts = count_array(map(operator.sub, ends, [0] + ends[:-1]))
+
+    @classmethod
+    def from_arrays(cls, starts, sizes, counts):
+        """
+        Create a block hitmap from parallel, sorted (start, size, count) arrays.
+        """
+        block_hitmap = cls()
+        block_hitmap.starts = starts
+        block_hitmap.sizes  = sizes
+        block_hitmap.counts = counts
+        return block_hitmap
+
+    @classmethod
+    def merge(cls, block_hitmaps):
+        """
+        Merge any number of block hitmaps into a single block hitmap, in one pass.
+        """
+        block_hitmaps = [block_hitmap for block_hitmap in block_hitmaps if block_hitmap]
+
+        # nothing to merge
+        if not block_hitmaps:
+            return cls()
+        elif len(block_hitmaps) == 1:
+            hitmap = block_hitmaps[0]
+            return cls.from_arrays(hitmap.starts, hitmap.sizes, hitmap.counts)
+
+        output = cls()
+
+        #
+        # perform a k-way merge of the (sorted) block entries, summing the
+        # counts of any blocks that appear in more than one block hitmap
+        #
+
+        entries = heapq.merge(*[block_hitmap.iteritems() for block_hitmap in block_hitmaps])
+        for block, group in itertools.groupby(entries, key=lambda x: x[0]):
+            output.starts.append(block[0])
+            output.sizes.append(block[1])
+            output.counts.append(sum(count for _, count in group))
+
+        return output
+
+    #--------------------------------------------------------------------------
+    # Properties
+    #--------------------------------------------------------------------------
+
+    @property
+    def intervals(self):
+        """
+        The (coalesced) address ranges covered by the blocks.
+        """
+        return IntervalSet.from_blocks(self.starts, self.sizes)
+
+    #--------------------------------------------------------------------------
+    # Mapping Interface
+    #--------------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return itertools.izip(self.starts, self.sizes)
+
+    def iteritems(self):
+        return itertools.izip(iter(self), self.counts)
+
+    #--------------------------------------------------------------------------
+    # Operations
+    #--------------------------------------------------------------------------
+
+    def rebase(self, base):
+        """
+        Return a copy of the block hitmap, shifted by the given base (offset).
+        """
+        starts = address_array(itertools.imap(operator.add, self.starts, itertools.repeat(base)))
+        return BlockHitmap.from_arrays(starts, self.sizes, self.counts)
+
+    def expand(self, metadata):
+        """
+        Expand the blocks to a CompactHitmap of their executed instructions.
+
+        The blocks are flattened against the given database metadata. The
+        hits of each block are counted against every instruction it holds.
+        """
+        if not self:
+            return CompactHitmap()
+        return metadata.flatten_blocks(self.starts, self.sizes, self.counts)
@@ -0,0 +1,701 @@
+import re
+import array
+import bisect
+import heapq
+import binascii
+import operator
+import itertools
+import collections
+
+#------------------------------------------------------------------------------
+# Compact Hitmap
+#------------------------------------------------------------------------------
+#
+#    A hitmap is a map of address --> number of executions. Storing one as a
+#    python dict costs well over 100 bytes per executed address, which adds
+#    up quickly for traces that cover millions of instructions.
+#
+#    The CompactHitmap defined in this file instead stores its addresses and
+#    hit counts as two parallel arrays, sorted by address. Lookups are done
+#    by bisection, and adding or subtracting hitmaps is done by merging the
+#    sorted arrays, rather than hashing each address.
+#
+#    The arrays held by a CompactHitmap are treated as immutable. Operations
+#    that change a hitmap swap in new arrays rather than modifying them in
+#    place, which makes it safe to share them with other objects.
+#
+
+def _address_typecode():
+    """
+    Select an array typecode capable of holding 64bit addresses.
+    """
+    for typecode in ["L", "Q"]:
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            continue
+    return None
+
+ADDRESS_TYPECODE = _address_typecode()
+COUNT_TYPECODE   = "L"
+
+def address_array(addresses=()):
+    """
+    Create a compact array of addresses.
+
+    NOTE/COMPAT:
+
+      Python 2.x on Windows has no 64bit array typecode, so we fall back
+      to a plain list of addresses there (correct, but not compact).
+
+    """
+    if ADDRESS_TYPECODE:
+        return array.array(ADDRESS_TYPECODE, addresses)
+    return list(addresses)
+
+def count_array(counts=()):
+    """
+    Create a compact array of hit counts.
+    """
+    return array.array(COUNT_TYPECODE, counts)
+
+#------------------------------------------------------------------------------
+# Address Hashing
+#------------------------------------------------------------------------------
+#
+#    Coverage sets are compared and cached by a hash of their addresses. The
+#    hash of a set is the XOR of a hash of each of its addresses, which makes
+#    it independent of order, and lets it be updated incrementally: adding or
+#    removing an address from a set simply XOR's its hash in or out again.
+#
+#    Each address is hashed by multiplying it with a large odd constant, and
+#    keeping the high bits of the product. The multiply, shift, and XOR fold
+#    are all driven by C iterators, so no python code runs per address.
+#
+#    NOTE: this is a fast hash, not a unique fingerprint. Collisions between
+#    distinct sets are possible (if unlikely) and must be handled by callers.
+#
+
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+def address_hash(addresses):
+    """
+    Compute the (order independent) hash of the given unique addresses.
+    """
+    products = itertools.imap(operator.mul, addresses, itertools.repeat(_HASH_MULTIPLIER))
+    mixed = itertools.imap(operator.rshift, products, itertools.repeat(29))
+    return reduce(operator.xor, mixed, 0) & _HASH_MASK
+
+class CompactHitmap(object):
+    """
+    A compact hitmap of address --> hit count, backed by sorted arrays.
+    """
+
+    def __init__(self, data=None):
+        self.addresses = address_array()
+        self.counts    = count_array()
+
+        # if there is no input data, simply leave the hitmap empty
+        if not data:
+            return
+
+        # another hitmap, share its (immutable) arrays
+        if isinstance(data, CompactHitmap):
+            self.addresses, self.counts = data.addresses, data.counts
+            return
+
+        # an address set is already sorted and unique, each address is one hit
+        if isinstance(data, AddressSet):
+            self.addresses = data.addresses
+            self.counts = count_array([1]) * len(data.addresses)
+            return
+
+        # build the hitmap from the given list of (possibly repeated) addresses
+        self._build(data)
+
+    @classmethod
+    def from_arrays(cls, addresses, counts):
+        """
+        Create a hitmap from parallel, sorted (address, count) arrays.
+        """
+        hitmap = cls()
+        hitmap.addresses = addresses
+        hitmap.counts = counts
+        return hitmap
+
+    @classmethod
+    def merge(cls, hitmaps):
+        """
+        Merge any number of hitmaps into a single hitmap, in one pass.
+        """
+        hitmaps = [hitmap for hitmap in hitmaps if hitmap]
+
+        # nothing to merge
+        if not hitmaps:
+            return cls()
+        elif len(hitmaps) == 1:
+            return cls.from_arrays(hitmaps[0].addresses, hitmaps[0].counts)
+
+        addresses = address_array()
+        counts    = count_array()
+
+        #
+        # perform a k-way merge of the (sorted) hitmap entries, summing the
+        # counts of any addresses that appear in more than one hitmap
+        #
+
+        entries = heapq.merge(*[hitmap.iteritems() for hitmap in hitmaps])
+        for address, group in itertools.groupby(entries, key=lambda x: x[0]):
+            addresses.append(address)
+            counts.append(sum(count for _, count in group))
+
+        return cls.from_arrays(addresses, counts)
+
+    #--------------------------------------------------------------------------
+    # Mapping Interface
+    #--------------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def __contains__(self, address):
+        index = bisect.bisect_left(self.addresses, address)
+        return index < len(self.addresses) and self.addresses[index] == address
+
+    def __getitem__(self, address):
+        return self.get(address, 0)
+
+    def get(self, address, default=None):
+        """
+        Get the hit count for the given address.
+        """
+        index = bisect.bisect_left(self.addresses, address)
+        if index < len(self.addresses) and self.addresses[index] == address:
+            return self.counts[index]
+        return default
+
+    def keys(self):
+        return list(self.addresses)
+
+    def iterkeys(self):
+        return iter(self.addresses)
+
+    def itervalues(self):
+        return iter(self.counts)
+
+    def iteritems(self):
+        return itertools.izip(self.addresses, self.counts)
+
+    def viewkeys(self):
+        """
+        A set-like view of the addresses in this hitmap.
+        """
+        return AddressSet.from_sorted(self.addresses)
+
+    #--------------------------------------------------------------------------
+    # Operations
+    #--------------------------------------------------------------------------
+
+    def range(self, start, end):
+        """
+        Get the (start, end) indexes of the addresses in the range [start, end).
+        """
+        index_start = bisect.bisect_left(self.addresses, start)
+        index_end   = bisect.bisect_left(self.addresses, end, index_start)
+        return (index_start, index_end)
+
+    def slice(self, start, end):
+        """
+        Get a new hitmap of the entries in the address range [start, end).
+        """
+        index_start, index_end = self.range(start, end)
+        return CompactHitmap.from_arrays(
+            self.addresses[index_start:index_end],
+            self.counts[index_start:index_end]
+        )
+
+    def add(self, other):
+        """
+        Add the hits of another hitmap to this hitmap.
+
+        Returns an address array of the entries that are new to this hitmap.
+        """
+        if not other:
+            return address_array()
+        elif not self:
+            self.addresses, self.counts = other.addresses, other.counts
+            return other.addresses
+
+        # addition is commutative, so always walk the smaller hitmap
+        if len(other) > len(self):
+            big, small = other, self
+        else:
+            big, small = self, other
+
+        added     = address_array()
+        addresses = address_array()
+        counts    = count_array()
+        position  = 0
+
+        #
+        # for each entry of the smaller hitmap, bisect forward into the bigger
+        # hitmap and copy over the run of entries that precede it as a slice.
+        #
+        # the cost of this merge is proportional to the size of the smaller
+        # hitmap, rather than the size of both hitmaps.
+        #
+
+        for address, count in small.iteritems():
+            index = bisect.bisect_left(big.addresses, address, position)
+            addresses.extend(big.addresses[position:index])
+            counts.extend(big.counts[position:index])
+
+            # entries only found in the other hitmap are new to this one
+            if big is other:
+                added.extend(big.addresses[position:index])
+
+            # this address exists in both hitmaps, sum their hits
+            if index < len(big.addresses) and big.addresses[index] == address:
+                count += big.counts[index]
+                index += 1
+
+            # this address only exists in the smaller hitmap
+            elif small is other:
+                added.append(address)
+
+            addresses.append(address)
+            counts.append(count)
+            position = index
+
+        # copy over whatever remains of the bigger hitmap
+        addresses.extend(big.addresses[position:])
+        counts.extend(big.counts[position:])
+        if big is other:
+            added.extend(big.addresses[position:])
+
+        self.addresses, self.counts = addresses, counts
+        return added
+
+    def subtract(self, other):
+        """
+        Subtract the hits of another hitmap from this hitmap.
+
+        Returns an address array of the entries that dropped to zero hits.
+        """
+        removed   = address_array()
+        addresses = address_array()
+        counts    = count_array()
+        position  = 0
+
+        # walk the subtracted hitmap, copying over the runs of entries between
+        for address, count in other.iteritems():
+            index = bisect.bisect_left(self.addresses, address, position)
+            addresses.extend(self.addresses[position:index])
+            counts.extend(self.counts[position:index])
+            position = index
+
+            # this address isn't in our hitmap, so there's nothing to subtract
+            if not (index < len(self.addresses) and self.addresses[index] == address):
+                continue
+
+            position += 1
+            count = self.counts[index] - count
+
+            #
+            # if there is no longer any hits for this address, drop its entry
+            # from the hitmap. we don't want its entry to hang around because
+            # we use the hitmap addresses as a coverage bitmap/mask
+            #
+
+            if count <= 0:
+                removed.append(address)
+                continue
+
+            addresses.append(address)
+            counts.append(count)
+
+        # copy over whatever remains of our hitmap
+        addresses.extend(self.addresses[position:])
+        counts.extend(self.counts[position:])
+
+        self.addresses, self.counts = addresses, counts
+        return removed
+
+    def mask(self, addresses):
+        """
+        Get a new hitmap of only the entries matching the given addresses.
+        """
+        masked_addresses = address_array()
+        masked_counts    = count_array()
+
+        for address in addresses:
+            count = self.get(address, None)
+            if count is None:
+                continue
+            masked_addresses.append(address)
+            masked_counts.append(count)
+
+        return CompactHitmap.from_arrays(masked_addresses, masked_counts)
+
+    #--------------------------------------------------------------------------
+    # Internal
+    #--------------------------------------------------------------------------
+
+    def _build(self, data):
+        """
+        Build the hitmap from the given list of (possibly repeated) addresses.
+        """
+        ordered = sorted(data)
+
+        #
+        # the common case is that every address was only executed once. we
+        # can detect this cheaply, and build the arrays without a python loop
+        #
+
+        if len(set(ordered)) == len(ordered):
+            self.addresses = address_array(ordered)
+            self.counts = count_array([1]) * len(ordered)
+            return
+
+        # otherwise, count the executions of each address
+        for address, group in itertools.groupby(ordered):
+            self.addresses.append(address)
+            self.counts.append(sum(1 for _ in group))
+
+#------------------------------------------------------------------------------
+# Address Set
+#------------------------------------------------------------------------------
+
+class AddressSet(collections.Set):
+    """
+    An immutable set of addresses, backed by a sorted address array.
+
+    Set operations against other AddressSets are computed by merging their
+    sorted arrays. Operations against regular python sets are supported too,
+    and will produce regular python sets.
+    """
+
+    def __init__(self, addresses=()):
+        self.addresses = address_array(sorted(set(addresses)))
+
+    @classmethod
+    def from_sorted(cls, addresses):
+        """
+        Create an address set from an already sorted, unique address array.
+        """
+        address_set = cls.__new__(cls)
+        address_set.addresses = addresses
+        return address_set
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def __contains__(self, address):
+        index = bisect.bisect_left(self.addresses, address)
+        return index < len(self.addresses) and self.addresses[index] == address
+
+    def __eq__(self, other):
+        if not isinstance(other, AddressSet):
+            return collections.Set.__eq__(self, other)
+        return self.addresses == other.addresses
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __or__(self, other):
+        if not isinstance(other, AddressSet):
+            return collections.Set.__or__(self, other)
+        return AddressSet.from_sorted(_merge(self.addresses, other.addresses, True, True, True))
+
+    def __and__(self, other):
+        if not isinstance(other, AddressSet):
+            return collections.Set.__and__(self, other)
+        return AddressSet.from_sorted(_merge(self.addresses, other.addresses, False, False, True))
+
+    def __xor__(self, other):
+        if not isinstance(other, AddressSet):
+            return collections.Set.__xor__(self, other)
+        return AddressSet.from_sorted(_merge(self.addresses, other.addresses, True, True, False))
+
+    def __sub__(self, other):
+        if not isinstance(other, AddressSet):
+            return collections.Set.__sub__(self, other)
+        return AddressSet.from_sorted(_merge(self.addresses, other.addresses, True, False, False))
+
+    __ror__  = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+def _merge(a, b, keep_a, keep_b, keep_both):
+    """
+    Merge two sorted address arrays, selecting which addresses to keep.
+
+      keep_a    - keep addresses only found in 'a'
+      keep_b    - keep addresses only found in 'b'
+      keep_both - keep addresses found in both 'a' and 'b'
+
+    """
+
+    #
+    # walk the smaller of the two arrays, and bisect forward into the bigger
+    # one. the runs of the bigger array between each address of the smaller
+    # array are copied (or skipped) as whole slices.
+    #
+    # this makes the cost of a merge proportional to the smaller array,
+    # eg. removing the addresses of one trace from the aggregate.
+    #
+
+    if len(a) < len(b):
+        a, b = b, a
+        keep_a, keep_b = keep_b, keep_a
+
+    output = address_array()
+    position = 0
+
+    for address in b:
+        index = bisect.bisect_left(a, address, position)
+
+        # the addresses only found in the bigger array
+        if keep_a:
+            output.extend(a[position:index])
+
+        # this address is found in both arrays
+        if index < len(a) and a[index] == address:
+            if keep_both:
+                output.append(address)
+            index += 1
+
+        # this address is only found in the smaller array
+        elif keep_b:
+            output.append(address)
+
+        position = index
+
+    # copy over whatever remains of the bigger array
+    if keep_a:
+        output.extend(a[position:])
+
+    return output
+
+#------------------------------------------------------------------------------
+# Instruction Bitmap
+#------------------------------------------------------------------------------
+#
+#    Composing coverage (eg, 'A | B - C') is pure set algebra over the
+#    executed instruction addresses of each coverage set. Hashing or merging
+#    hundreds of thousands of addresses for every keystroke in the shell is
+#    far slower than it needs to be.
+#
+#    Instead, every instruction known to the database metadata is assigned
+#    a dense ordinal (its index in the sorted list of instruction addresses)
+#    and the instructions executed by a coverage set are encoded as a bitmap
+#    over those ordinals. The bitmap is held as a python long, so that the
+#    set operations are computed by the interpreter a machine word at a time.
+#
+#    Executed addresses that are not known instructions (eg, code outside
+#    of defined functions) are held separately, as a regular AddressSet.
+#
+
+# the set bit positions of every possible byte value
+_BYTE_BITS = [[bit for bit in xrange(8) if value & (1 << bit)] for value in xrange(256)]
+
+# matches the non-zero bytes of a bitmap
+_NONZERO_BYTE = re.compile(r"[^\x00]")
+
+class InstructionBitmap(AddressSet):
+    """
+    A set of addresses, encoded as a bitmap over dense instruction ordinals.
+    """
+
+    def __init__(self, addresses, instructions):
+        self.instructions = instructions
+        bitmap   = bytearray((len(instructions) + 7) >> 3)
+        unmapped = address_array()
+
+        #
+        # the given addresses are sorted, so the ordinal of each address can
+        # only be greater than that of the address before it. this lets us
+        # narrow each bisection of the instruction addresses
+        #
+
+        ordinal, count = 0, len(instructions)
+        for address in addresses:
+            ordinal = bisect.bisect_left(instructions, address, ordinal)
+
+            # a known instruction, set its bit in the bitmap
+            if ordinal < count and instructions[ordinal] == address:
+                bitmap[ordinal >> 3] |= 1 << (ordinal & 7)
+
+            # not a known instruction, so it is held separately
+            else:
+                unmapped.append(address)
+
+        self.unmapped = AddressSet.from_sorted(unmapped)
+        self._bitmap = bitmap
+        self._bits = None
+        self._addresses = None
+
+    @classmethod
+    def _from_bits(cls, instructions, bits, unmapped):
+        """
+        Create an instruction bitmap from its raw components.
+        """
+        instruction_bitmap = cls.__new__(cls)
+        instruction_bitmap.instructions = instructions
+        instruction_bitmap.unmapped = unmapped
+        instruction_bitmap._bitmap = None
+        instruction_bitmap._bits = bits
+        instruction_bitmap._addresses = None
+        return instruction_bitmap
+
+    #--------------------------------------------------------------------------
+    # Properties
+    #--------------------------------------------------------------------------
+
+    @property
+    def bits(self):
+        """
+        The instruction ordinal bitmap, as a python long.
+        """
+        if self._bits is None:
+            self._bits = _bytes_to_bits(self._bitmap)
+        return self._bits
+
+    @property
+    def bitmap(self):
+        """
+        The instruction ordinal bitmap, as a little endian bytearray.
+        """
+        if self._bitmap is None:
+            self._bitmap = _bits_to_bytes(self._bits, (len(self.instructions) + 7) >> 3)
+        return self._bitmap
+
+    @property
+    def addresses(self):
+        """
+        The sorted address array of this set (built on demand).
+        """
+        if self._addresses is None:
+            instructions = self.instructions
+            mapped = address_array(instructions[ordinal] for ordinal in self.ordinals())
+            self._addresses = _merge(mapped, self.unmapped.addresses, True, True, True)
+        return self._addresses
+
+    @property
+    def instruction_count(self):
+        """
+        The number of known instructions in this set (a popcount).
+        """
+        return bin(self.bits).count("1")
+
+    @property
+    def instruction_percent(self):
+        """
+        The % of all known instructions that are in this set.
+        """
+        if not self.instructions:
+            return 0.0
+        return float(self.instruction_count) / len(self.instructions)
+
+    #--------------------------------------------------------------------------
+    # Set Interface
+    #--------------------------------------------------------------------------
+
+    def __len__(self):
+        return self.instruction_count + len(self.unmapped)
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def __contains__(self, address):
+        ordinal = bisect.bisect_left(self.instructions, address)
+        if ordinal < len(self.instructions) and self.instructions[ordinal] == address:
+            return bool(self.bitmap[ordinal >> 3] & (1 << (ordinal & 7)))
+        return address in self.unmapped
+
+    def __eq__(self, other):
+        if self._is_compatible(other):
+            return self.bits == other.bits and self.unmapped == other.unmapped
+        return AddressSet.__eq__(self, other)
+
+    def ordinals(self):
+        """
+        Iterate the (ascending) instruction ordinals set in this bitmap.
+        """
+        for match in _NONZERO_BYTE.finditer(bytes(self.bitmap)):
+            index = match.start()
+            for bit in _BYTE_BITS[ord(match.group())]:
+                yield (index << 3) | bit
+
+    def __or__(self, other):
+        if self._is_compatible(other):
+            return self._combine(other, operator.or_, operator.or_)
+        return AddressSet.__or__(self, other)
+
+    def __and__(self, other):
+        if self._is_compatible(other):
+            return self._combine(other, operator.and_, operator.and_)
+        return AddressSet.__and__(self, other)
+
+    def __xor__(self, other):
+        if self._is_compatible(other):
+            return self._combine(other, operator.xor, operator.xor)
+        return AddressSet.__xor__(self, other)
+
+    def __sub__(self, other):
+        if self._is_compatible(other):
+            return self._combine(other, lambda x, y: x & ~y, operator.sub)
+        return AddressSet.__sub__(self, other)
+
+    __ror__  = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+    #--------------------------------------------------------------------------
+    # Internal
+    #--------------------------------------------------------------------------
+
+    def _is_compatible(self, other):
+        """
+        Check if the given set is a bitmap over the same instruction ordinals.
+        """
+        return isinstance(other, InstructionBitmap) and other.instructions is self.instructions
+
+    def _combine(self, other, bits_operator, unmapped_operator):
+        """
+        Combine two compatible bitmaps with the given operators.
+        """
+        return InstructionBitmap._from_bits(
+            self.instructions,
+            bits_operator(self.bits, other.bits),
+            unmapped_operator(self.unmapped, other.unmapped)
+        )
+
+def _bytes_to_bits(data):
+    """
+    Convert a little endian bytearray to a python long.
+    """
+    if not data:
+        return 0L
+    return long(binascii.hexlify(bytes(data[::-1])), 16)
+
+def _bits_to_bytes(bits, size):
+    """
+    Convert a python long to a little endian bytearray of the given size.
+    """
+    if not size:
+        return bytearray()
+    hexed = ("%x" % bits).zfill(size * 2)
+    return bytearray(binascii.unhexlify(hexed))[::-1]
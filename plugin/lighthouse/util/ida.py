@@ -184,6 +184,15 @@ def lex_citem_indexes(line):
 # Misc
 #------------------------------------------------------------------------------
 
+def get_database_change_count():
+    """
+    Get the change counter of the open database.
+
+    The counter is bumped by IDA whenever bytes or segments of the database
+    are modified. Returns None if this version of IDA does not expose it.
+    """
+    return getattr(idaapi.cvar.inf, "database_change_count", None)
+
 def get_disas_bg_color():
     """
     Get the background color of an IDA disassembly view.
@@ -0,0 +1,291 @@
+import heapq
+import bisect
+import operator
+import itertools
+
+from .hitmap import address_array
+
+#------------------------------------------------------------------------------
+# Interval Set
+#------------------------------------------------------------------------------
+#
+#    Coverage is loaded as (address, size) basic blocks, which are regularly
+#    sorted, merged, and shifted around before they are flattened into the
+#    individual instructions they execute. Doing this with lists of tuples
+#    costs a python object (or three) per block, and coalescing them by
+#    popping from the front of a list is quadratic.
+#
+#    The IntervalSet defined in this file instead stores a set of address
+#    ranges as two parallel arrays of (half-open) start and end addresses,
+#    sorted by address. The intervals of a set are always coalesced, such
+#    that no two intervals overlap or touch.
+#
+#    Because both operands of a set operation are sorted and coalesced, the
+#    union, intersection, and difference of two interval sets are computed
+#    in a single, linear sweep over their intervals.
+#
+
+class IntervalSet(object):
+    """
+    An immutable set of [start, end) address intervals, backed by sorted arrays.
+    """
+
+    def __init__(self, intervals=()):
+        self.starts = address_array()
+        self.ends   = address_array()
+
+        # coalesce the given (start, end) intervals, in any order
+        self._coalesce(sorted(intervals))
+
+    @classmethod
+    def from_blocks(cls, starts, sizes):
+        """
+        Create an interval set from parallel (starts, sizes) block arrays.
+        """
+        ends = itertools.imap(operator.add, starts, sizes)
+        intervals = itertools.izip(starts, ends)
+
+        #
+        # coverage blocks are often already sorted (eg, when extracted from
+        # a sorted log). we can detect this cheaply, and skip the sort
+        #
+
+        if not _is_sorted(starts):
+            intervals = sorted(intervals)
+
+        interval_set = cls.__new__(cls)
+        interval_set.starts = address_array()
+        interval_set.ends   = address_array()
+        interval_set._coalesce(intervals)
+        return interval_set
+
+    @classmethod
+    def from_sorted(cls, starts, ends):
+        """
+        Create an interval set from already sorted, coalesced interval arrays.
+        """
+        interval_set = cls.__new__(cls)
+        interval_set.starts = starts
+        interval_set.ends   = ends
+        return interval_set
+
+    #--------------------------------------------------------------------------
+    # Properties
+    #--------------------------------------------------------------------------
+
+    @property
+    def size(self):
+        """
+        The total number of bytes covered by the set.
+        """
+        return sum(itertools.imap(operator.sub, self.ends, self.starts))
+
+    @property
+    def sizes(self):
+        """
+        The sizes of the intervals in the set, in address order.
+        """
+        return address_array(itertools.imap(operator.sub, self.ends, self.starts))
+
+    #--------------------------------------------------------------------------
+    # Queries
+    #--------------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return itertools.izip(self.starts, self.ends)
+
+    def __contains__(self, address):
+        return self.find(address) != -1
+
+    def find(self, address):
+        """
+        Return the index of the interval containing the given address, or -1.
+        """
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index >= 0 and address < self.ends[index]:
+            return index
+        return -1
+
+    def contains_range(self, start, end):
+        """
+        Return True if the [start, end) range is entirely covered by the set.
+        """
+        index = self.find(start)
+        return index != -1 and end <= self.ends[index]
+
+    def select(self, addresses):
+        """
+        Select the addresses of a sorted address array that fall in the set.
+        """
+        output = address_array()
+
+        #
+        # walk the intervals, and bisect forward into the (sorted) addresses
+        # for the run of addresses that falls within each interval. the runs
+        # are copied over as whole slices
+        #
+
+        position = 0
+        address_count = len(addresses)
+        for start, end in self:
+            position = bisect.bisect_left(addresses, start, position)
+            if position == address_count:
+                break
+            run_end = bisect.bisect_left(addresses, end, position)
+            output.extend(addresses[position:run_end])
+            position = run_end
+
+        return output
+
+    def blocks(self):
+        """
+        Return an iterator of the (address, size) blocks in the set.
+        """
+        return itertools.izip(self.starts, itertools.imap(operator.sub, self.ends, self.starts))
+
+    #--------------------------------------------------------------------------
+    # Operations
+    #--------------------------------------------------------------------------
+
+    def rebase(self, base):
+        """
+        Return a copy of the set, shifted by the given base (offset).
+        """
+        offset = itertools.repeat(base)
+        return IntervalSet.from_sorted(
+            address_array(itertools.imap(operator.add, self.starts, offset)),
+            address_array(itertools.imap(operator.add, self.ends, offset))
+        )
+
+    def union(self, other):
+        """
+        Return the union of this set with another.
+        """
+        output = IntervalSet()
+        output._coalesce(heapq.merge(iter(self), iter(other)))
+        return output
+
+    def intersection(self, other):
+        """
+        Return the intersection of this set with another.
+        """
+        output = IntervalSet()
+        a_starts, a_ends = self.starts, self.ends
+        b_starts, b_ends = other.starts, other.ends
+
+        #
+        # sweep the two sets together. the overlap of the current interval
+        # from each set (if any) is kept, and whichever interval ends first
+        # can no longer overlap anything else, so we step past it
+        #
+
+        i, j = 0, 0
+        while i < len(a_starts) and j < len(b_starts):
+            start = max(a_starts[i], b_starts[j])
+            end = min(a_ends[i], b_ends[j])
+
+            if start < end:
+                output.starts.append(start)
+                output.ends.append(end)
+
+            if a_ends[i] < b_ends[j]:
+                i += 1
+            else:
+                j += 1
+
+        return output
+
+    def difference(self, other):
+        """
+        Return the set of intervals in this set, but not the other.
+        """
+        output = IntervalSet()
+        b_starts, b_ends = other.starts, other.ends
+        b_count = len(b_starts)
+
+        j = 0
+        for start, end in self:
+
+            # skip the intervals that end before this interval starts
+            while j < b_count and b_ends[j] <= start:
+                j += 1
+
+            #
+            # carve the overlapping intervals out of this one. the last of
+            # them may extend beyond this interval, so it is not stepped past
+            # as it may carve into the next interval too
+            #
+
+            k = j
+            while k < b_count and b_starts[k] < end:
+                if b_starts[k] > start:
+                    output.starts.append(start)
+                    output.ends.append(b_starts[k])
+                start = max(start, b_ends[k])
+                if b_ends[k] >= end:
+                    break
+                k += 1
+
+            # keep whatever remains of this interval
+            if start < end:
+                output.starts.append(start)
+                output.ends.append(end)
+
+        return output
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return self.starts == other.starts and self.ends == other.ends
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    __or__  = union
+    __and__ = intersection
+    __sub__ = difference
+
+    #--------------------------------------------------------------------------
+    # Internal
+    #--------------------------------------------------------------------------
+
+    def _coalesce(self, intervals):
+        """
+        Coalesce (start, end) intervals sorted by start onto this set.
+        """
+        starts, ends = self.starts, self.ends
+
+        current_start, current_end = None, None
+        for start, end in intervals:
+
+            # skip any empty intervals
+            if start >= end:
+                continue
+
+            # the interval overlaps (or touches) the current one, extend it
+            if current_end is not None and start <= current_end:
+                if end > current_end:
+                    current_end = end
+                continue
+
+            # the interval starts a new coalescing interval
+            if current_end is not None:
+                starts.append(current_start)
+                ends.append(current_end)
+            current_start, current_end = start, end
+
+        if current_end is not None:
+            starts.append(current_start)
+            ends.append(current_end)
+
+def _is_sorted(values, strict=False):
+    """
+    Return True if the given sequence is sorted (in ascending order).
+
+    If strict is True, the sequence must also be free of repeated values.
+    """
+    compare = operator.lt if strict else operator.le
+    return all(itertools.imap(compare, values, itertools.islice(values, 1, None)))
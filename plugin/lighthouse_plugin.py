@@ -1,5 +1,3 @@
-import os
-
 from idaapi import plugin_t
 
 from lighthouse.ui import *
@@ -8,7 +6,9 @@ from lighthouse.parsers import *
 from lighthouse.palette import LighthousePalette
 from lighthouse.painting import CoveragePainter
 from lighthouse.director import CoverageDirector
-from lighthouse.metadata import DatabaseMetadata, metadata_progress
+from lighthouse.metadata import DatabaseMetadata
+from lighthouse.modules import get_database_modules
+from lighthouse.pipeline import CoveragePipeline, CoverageFollower
 
 # start the global logger *once*
 if not logging_started():
@@ -53,10 +53,20 @@ class Lighthouse(plugin_t):
         # plugin qt elements
         self._ui_coverage_overview = CoverageOverview(self.director)
 
+        # progress dialogs of any coverage that is still loading
+        self._ui_loading_dialogs = []
+
+        # followers of live coverage files, by coverage name
+        self._coverage_followers = {}
+
         # members for the 'Load Code Coverage' menu entry
         self._icon_id_load     = idaapi.BADADDR
         self._action_name_load = "lighthouse:load_coverage"
 
+        # members for the 'Follow Code Coverage' menu entry
+        self._icon_id_follow     = idaapi.BADADDR
+        self._action_name_follow = "lighthouse:follow_coverage"
+
         # members for the 'Coverage Overview' menu entry
         self._icon_id_overview     = idaapi.BADADDR
         self._action_name_overview = "lighthouse:coverage_overview"
@@ -145,6 +155,7 @@ class Lighthouse(plugin_t):
 
         # install the 'Load Coverage' file dialog
         self._install_load_file_dialog()
+        self._install_follow_file_dialog()
         self._install_open_coverage_overview()
 
     def _install_load_file_dialog(self):
@@ -183,6 +194,42 @@ class Lighthouse(plugin_t):
 
         logger.info("Installed the 'Load Code Coverage' menu entry")
 
+    def _install_follow_file_dialog(self):
+        """
+        Install the 'File->Load->Follow Code Coverage File(s)...' menu entry.
+        """
+
+        # create a custom IDA icon
+        self._icon_id_follow = idaapi.load_custom_icon(
+            data=str(open(plugin_resource("icons/load.png"), "rb").read())
+        )
+
+        # describe a custom IDA UI action
+        action_desc = idaapi.action_desc_t(
+            self._action_name_follow,                 # The action name.
+            "~F~ollow Code Coverage File(s)...",      # The action text.
+            IDACtxEntry(self.follow_coverage),        # The action handler.
+            None,                                     # Optional: action shortcut
+            "Load a live code coverage file, and follow it as it grows", # Optional: tooltip
+            self._icon_id_follow                      # Optional: the action icon
+        )
+
+        # register the action with IDA
+        result = idaapi.register_action(action_desc)
+        if not result:
+            RuntimeError("Failed to register follow coverage action with IDA")
+
+        # attach the action to the File-> dropdown menu
+        result = idaapi.attach_action_to_menu(
+            "File/Load file/",         # Relative path of where to add the action
+            self._action_name_follow,  # The action ID (see above)
+            idaapi.SETMENU_APP         # We want to append the action after ^
+        )
+        if not result:
+            RuntimeError("Failed action attach to 'File/Load file/' dropdown")
+
+        logger.info("Installed the 'Follow Code Coverage' menu entry")
+
     def _install_open_coverage_overview(self):
         """
         Install the 'View->Open subviews->Coverage Overview' menu entry.
@@ -228,6 +275,7 @@ class Lighthouse(plugin_t):
         Cleanup & uninstall the plugin from IDA.
         """
         self._uninstall_ui()
+        self.director.terminate()
 
     #--------------------------------------------------------------------------
     # Termination - UI
@@ -237,7 +285,17 @@ class Lighthouse(plugin_t):
         """
         Cleanup & uninstall the plugin UI from IDA.
         """
+
+        # stop loading any coverage that is still in flight
+        for dialog in self._ui_loading_dialogs:
+            dialog.cancel()
+
+        # stop following any live coverage files
+        for follower in self._coverage_followers.itervalues():
+            follower.stop()
+
         self._uninstall_open_coverage_overview()
+        self._uninstall_follow_file_dialog()
         self._uninstall_load_file_dialog()
 
     def _uninstall_load_file_dialog(self):
@@ -264,6 +322,30 @@ class Lighthouse(plugin_t):
 
         logger.info("Uninstalled the 'Load Code Coverage' menu entry")
 
+    def _uninstall_follow_file_dialog(self):
+        """
+        Remove the 'File->Load file->Follow Code Coverage File(s)...' menu entry.
+        """
+
+        # remove the entry from the File-> menu
+        result = idaapi.detach_action_from_menu(
+            "File/Load file/",
+            self._action_name_follow
+        )
+        if not result:
+            return False
+
+        # unregister the action
+        result = idaapi.unregister_action(self._action_name_follow)
+        if not result:
+            return False
+
+        # delete the entry's icon
+        idaapi.free_custom_icon(self._icon_id_follow)
+        self._icon_id_follow = idaapi.BADADDR
+
+        logger.info("Uninstalled the 'Follow Code Coverage' menu entry")
+
     def _uninstall_open_coverage_overview(self):
         """
         Remove the 'View->Open subviews->Coverage Overview' menu entry.
@@ -305,7 +387,21 @@ class Lighthouse(plugin_t):
         # manipulate loaded coverage data in a performant, asynchronous manner.
         #
 
-        future = self.director.metadata.refresh(progress_callback=metadata_progress)
+        future = self.director.refresh_metadata()
+
+        #
+        # the functions around the cursor are what the user will be looking
+        # at first, so we ask for their metadata to be collected first
+        #
+
+        CURSOR_RANGE = 0x1000
+
+        cursor_address = idaapi.get_screen_ea()
+        start_address = max(0, cursor_address - CURSOR_RANGE)
+        self.director.metadata.prioritize([
+            (cursor_address, cursor_address + 1),
+            (start_address, cursor_address + CURSOR_RANGE)
+        ])
 
         #
         # prompt the user with a QtFileDialog so that they can select any
@@ -318,12 +414,6 @@ class Lighthouse(plugin_t):
         if not filenames:
             return
 
-        #
-        # load the selected coverage files from disk
-        #
-
-        coverage_data = self._load_coverage_files(filenames)
-
         #
         # refresh the theme aware color palette for lighthouse
         #
@@ -331,55 +421,104 @@ class Lighthouse(plugin_t):
         self.palette.refresh_colors()
 
         #
-        # to continue any further, we need the database metadata. hopefully
-        # it has finished with its asynchronous collection, otherwise we will
-        # block until it completes. the user will be shown a progress dialog.
+        # stream the selected coverage files through the loading pipeline.
+        # they are parsed, normalized, and mapped in the background, so IDA
+        # remains interactive while they load (see CoveragePipeline).
+        #
+        # rather than waiting for the metadata of the entire database, each
+        # coverage file will only wait on the metadata of the functions it
+        # touches. the rest is collected in the background.
         #
 
-        idaapi.show_wait_box("Building database metadata...")
-        await_future(future)
+        pipeline = CoveragePipeline(self.director, filenames, get_database_modules())
+
+        # show the progress of the pipeline, and let the user cancel it
+        dialog = CoverageLoadingDialog(pipeline)
+        dialog.firstCoverageLoaded.connect(self._first_coverage_loaded)
+        dialog.loadingFinished.connect(
+            lambda: self._coverage_loading_finished(dialog, pipeline, future)
+        )
+        self._ui_loading_dialogs.append(dialog)
+
+        pipeline.start()
+        dialog.show()
+
+    def _first_coverage_loaded(self, coverage_name):
+        """
+        Handle the first coverage surfaced by a coverage pipeline.
+        """
 
         #
-        # at this point the metadata caching is guaranteed to be complete.
-        # the coverage data has been loaded and is ready for mapping.
+        # the first coverage file is made viewable as soon as it has been
+        # mapped, while the rest of the batch continues to load
         #
 
-        idaapi.replace_wait_box("Normalizing and mapping coverage data...")
+        self.director.select_coverage(coverage_name)
+        self.open_coverage_overview()
+
+    def _coverage_loading_finished(self, dialog, pipeline, future):
+        """
+        Handle the completion of a coverage pipeline.
+        """
+        self._ui_loading_dialogs.remove(dialog)
+
+        # report any coverage files that failed to load
+        for filepath, error in pipeline.errors:
+            lmsg("Failed to load coverage file %s:" % filepath)
+            lmsg("- %s" % error)
+
+        if pipeline.cancelled:
+            lmsg("Coverage loading cancelled by user...")
 
         #
-        # TODO:
-        #
-        #   I do not hold great confidence in this code yet, so let's wrap
-        #   this in a try/catch so the user doesn't get stuck with a wait
-        #   box they can't close should things go poorly ;P
+        # the rest of the metadata is still being collected in the background.
+        # the loaded coverage is mapped to it as it arrives, and is re-mapped
+        # once more when it has all been collected
         #
 
-        try:
+        self.director.await_metadata(future)
 
-            for data in coverage_data:
+        # print a success message to the output window
+        lmsg("loaded %u coverage file(s)..." % len(pipeline.loaded))
 
-                # normalize coverage data to the database
-                name = os.path.basename(data.filepath)
-                addresses = self._normalize_coverage(data, self.director.metadata)
+    def follow_coverage(self):
+        """
+        An interactive file dialog flow for following live code coverage files.
+        """
 
-                # enlighten the coverage director to this new runtime data
-                self.director.add_coverage(name, addresses)
+        # kick off an asynchronous metadata refresh (see load_coverage)
+        future = self.director.refresh_metadata()
 
-            # select the 'first' coverage file loaded
-            self.director.select_coverage(self.director.coverage_names[0])
+        # prompt the user to select the coverage file(s) to follow
+        filenames = self._select_coverage_files()
+        if not filenames:
+            return
 
-            idaapi.hide_wait_box()
+        # refresh the theme aware color palette for lighthouse
+        self.palette.refresh_colors()
 
-        # 'something happened :('
-        except Exception as e:
-            idaapi.hide_wait_box()
-            lmsg("Failed to load coverage:")
-            lmsg("- %s" % e)
-            logger.exception(e)
-            return
+        #
+        # each selected coverage file is followed in the background. the log
+        # is loaded as a coverage set with the blocks it holds so far, and the
+        # blocks appended to it are pushed into that coverage set as it grows
+        #
 
-        # print a success message to the output window
-        lmsg("loaded %u coverage file(s)..." % len(coverage_data))
+        database_modules = get_database_modules()
+        for filepath in filenames:
+            follower = CoverageFollower(self.director, filepath, database_modules)
+
+            # stop any follower already feeding the same coverage set
+            old_follower = self._coverage_followers.get(follower.coverage_name, None)
+            if old_follower:
+                old_follower.stop()
+
+            self._coverage_followers[follower.coverage_name] = follower
+            follower.start()
+
+            lmsg("Following coverage file %s..." % filepath)
+
+        # re-map the followed coverage once the metadata has been collected
+        self.director.await_metadata(future)
 
         # show the coverage overview
         self.open_coverage_overview()
@@ -408,47 +547,3 @@ class Lighthouse(plugin_t):
 
         # return the captured filenames
         return filenames
-
-    #--------------------------------------------------------------------------
-    # Misc
-    #--------------------------------------------------------------------------
-
-    def _load_coverage_files(self, filenames):
-        """
-        Load multiple code coverage files from disk.
-        """
-        return [self._load_coverage_file(filename) for filename in filenames]
-
-    def _load_coverage_file(self, filename):
-        """
-        Load a single code coverage file from disk.
-
-        TODO: Add other formats. Only drcov logs supported for now.
-        """
-        return DrcovData(filename)
-
-    def _normalize_coverage(self, coverage_data, metadata):
-        """
-        Normalize loaded coverage data to the database metadata.
-
-        TODO:
-
-          This will probably be moved out and turn into a layer for each unique
-          lighthouse coverage parser/loader to implement.
-
-          for example, this effectively translate the DrcovData log to a more
-          general / universal format for the director.
-
-        """
-
-        # extract the coverage relevant to this IDB (well, the root binary)
-        root_filename   = idaapi.get_root_filename()
-        coverage_blocks = coverage_data.filter_by_module(root_filename)
-
-        # rebase the basic blocks
-        base = idaapi.get_imagebase()
-        rebased_blocks = rebase_blocks(base, coverage_blocks)
-
-        # flatten the basic blocks into individual instructions or addresses
-        return metadata.flatten_blocks(rebased_blocks)
-